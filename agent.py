@@ -17,21 +17,28 @@ limitations under the License.
 import json
 import logging
 import random
-import re
 import time
 import z3
+from collections import Counter
 import os
 import argparse
+import queue
 import threading
 import subprocess
 import shlex
 
-import timeout_decorator
 
+import numpy as np
 import torch
 import torch.nn as nn
 
 from utils.strategy import StrategyEnumerator
+from utils.baseline import BaselineTable, compute_baseline
+from utils.cache import ResultCache, goal_fingerprint, goal_hash
+from utils.probes import default_features
+from utils import parallel
+from utils.goal_store import to_smt2
+from utils.solver_pool import SolverPool
 from language import objects
 
 
@@ -54,32 +61,32 @@ ALL_TOKENS = ["UNK"] + ST_TOKENS + BV_THEORY
 
 
 class Z3Runner(threading.Thread):
-    def __init__(self, smt_file, timeout, strategy=None, id=1):
+    def __init__(self, smt_file, timeout, strategy=None, id=1, budget=0):
         threading.Thread.__init__(self)
         self.smt_file = smt_file
         self.timeout = timeout
+        self.budget = budget
         self.strategy = strategy
-        RND = 'tmp'
+        self.new_file_name = self.smt_file
 
+        # the rewritten script is piped to z3, so concurrent runners can not clobber each other's files
+        self.script = None
         if self.strategy is not None:
-            self.tmp_file = open('tmp/tmp_valid_{}_{}.smt2'.format(RND, id), 'w')
             with open(self.smt_file, 'r') as f:
-                for line in f:
-                    new_line = line
-                    if 'check-sat' in line:
-                        new_line = '(check-sat-using %s)\n' % strategy
-                    self.tmp_file.write(new_line)
-            self.tmp_file.close()
-            self.new_file_name = 'tmp/tmp_valid_{}_{}.smt2'.format(RND, id)
-        else:
-            self.new_file_name = self.smt_file
+                self.script = ''.join([('(check-sat-using %s)\n' % strategy) if 'check-sat' in line else line
+                                       for line in f]).encode('utf-8')
 
     def run(self):
         self.time_before = time.time()
-        z3_cmd = 'z3 -smt2 %s -st' % self.new_file_name
-        
-        self.p = subprocess.Popen(shlex.split(z3_cmd), stdout=subprocess.PIPE)
-        self.p.wait()
+        if self.script is not None:
+            z3_cmd = 'z3 -smt2 -in -st'
+        else:
+            z3_cmd = 'z3 -smt2 %s -st' % self.smt_file
+        if self.budget > 0:
+            z3_cmd += ' rlimit=%d' % self.budget
+
+        self.p = subprocess.Popen(shlex.split(z3_cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.out, _ = self.p.communicate(self.script)
         self.time_after = time.time()
 
     def collect(self):
@@ -91,9 +98,7 @@ class Z3Runner(threading.Thread):
                 pass
             return None, None, None
 
-        out, err = self.p.communicate()
-
-        lines = out[:-1].decode("utf-8").split('\n')
+        lines = self.out[:-1].decode("utf-8").split('\n')
         res = lines[0]
 
         rlimit = None
@@ -110,69 +115,271 @@ class Z3Runner(threading.Thread):
         return res, rlimit, self.time_after-self.time_before
 
 class GoalTokenizer(object):
-    def __init__(self):
+    SEPARATORS = str.maketrans('()\n[],', ' ' * 6)
+
+    def __init__(self, ast_bow=False):
+        """ Initializes object of type GoalTokenizer.
+
+        :param ast_bow: count z3 formulas on their AST instead of their SMT-LIB text, faster on large goals
+        with shared subterms but the counts differ from the text ones, see bow_ast
+        """
+        self.ast_bow = ast_bow
         self.token_idx = {}
         for token_i, token in enumerate(ALL_TOKENS):
             self.token_idx[token] = token_i
 
     def bow(self, txt):
-        if type(txt) is not str:
-            txt = str(txt)
+        """ Returns bag of words vector of a formula, given as text or as z3 expression, AST vector or goal. """
+        if not isinstance(txt, str):
+            if self.ast_bow:
+                return self.bow_ast(txt)
+            txt = txt.sexpr()
 
-        txt = re.sub(r'[()\n]', ' ', txt)
-        txt = re.sub(r'[\[\],]', ' ', txt)
-        txt = re.sub(r"\[|]+", ' ', txt)
+        ret = [0 for _ in ALL_TOKENS]
+        for token, cnt in Counter(txt.translate(self.SEPARATORS).split(' ')).items():
+            ret[self.token_idx.get(token.lower(), 0)] += cnt
+        return ret
 
-        tokens = txt.split(' ')
+    def bow_ast(self, formula):
+        """ Counts the tokens of formula on its AST. Every shared subterm is visited once, so the cost depends on
+        the number of distinct subterms instead of the size of the let-expanded text. The counts are not the
+        ones of bow on the text: shared subterms count once, whitespace, constant names and the goal header
+        add nothing to UNK, so models have to be trained on the features they are evaluated with. """
+        ctx = formula.ctx.ref()
+        if isinstance(formula, (z3.Goal, z3.AstVector)):
+            stack = [formula[i].as_ast() for i in range(len(formula))]
+        else:
+            stack = [formula.as_ast()]
 
         ret = [0 for _ in ALL_TOKENS]
-        for token in tokens:
-            token = token.lower()
-            if token not in self.token_idx:
+        seen = set()
+        # ast ids are recycled once the terms are freed, so declarations are only memoized during one call
+        decls = {}
+        while len(stack) > 0:
+            a = stack.pop()
+            ast_id = z3.Z3_get_ast_id(ctx, a)
+            if ast_id in seen:
+                continue
+            seen.add(ast_id)
+            kind = z3.Z3_get_ast_kind(ctx, a)
+            if kind == z3.Z3_QUANTIFIER_AST:
+                ret[self.token_idx['forall' if z3.Z3_is_quantifier_forall(ctx, a) else 'exists']] += 1
+                ret[0] += z3.Z3_get_quantifier_num_bound(ctx, a)
+                stack.append(z3.Z3_get_quantifier_body(ctx, a))
+                continue
+            if kind != z3.Z3_APP_AST and kind != z3.Z3_NUMERAL_AST:
                 ret[0] += 1
-            else:
-                ret[self.token_idx[token]] += 1
+                continue
+
+            app = z3.Z3_to_app(ctx, a)
+            d = z3.Z3_get_app_decl(ctx, app)
+            decl_id = z3.Z3_get_ast_id(ctx, z3.Z3_func_decl_to_ast(ctx, d))
+            if decl_id not in decls:
+                name = z3.Z3_get_symbol_string(ctx, z3.Z3_get_decl_name(ctx, d))
+                decls[decl_id] = (self.token_idx.get(name.lower(), 0), z3.Z3_get_decl_num_parameters(ctx, d))
+            token_i, n_params = decls[decl_id]
+            ret[token_i] += 1
+            n_args = z3.Z3_get_app_num_args(ctx, app)
+            if n_args > 0:
+                if n_params > 0:
+                    # indexed operators like (_ extract 7 0)
+                    ret[self.token_idx['_']] += 1
+                    ret[0] += n_params
+                for i in range(n_args):
+                    stack.append(z3.Z3_get_app_arg(ctx, app, i))
         return ret
 
 
+class SumTree:
+    """ Binary tree of priority sums over a power of two number of leaves, all operations work on whole
+    index arrays and touch O(log n) nodes per index. """
+
+    def __init__(self, capacity):
+        self.leaves = 1
+        while self.leaves < capacity:
+            self.leaves *= 2
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[idx + self.leaves]
+
+    def update(self, idx, priorities):
+        pos = idx + self.leaves
+        self.tree[pos] = priorities
+        pos = np.unique(pos // 2)
+        while pos[0] >= 1:
+            self.tree[pos] = self.tree[2 * pos] + self.tree[2 * pos + 1]
+            pos = np.unique(pos // 2)
+            if pos[-1] == 0:
+                break
+
+    def find(self, values):
+        """ Returns leaf indices whose prefix sum interval contains values. """
+        pos = np.ones(len(values), dtype=np.int64)
+        while pos[0] < self.leaves:
+            left = 2 * pos
+            go_right = values >= self.tree[left]
+            values = np.where(go_right, values - self.tree[left], values)
+            pos = np.where(go_right, left + 1, left)
+        return pos - self.leaves
+
+
+class ReplayRing:
+    """ Preallocated circular buffer of transitions, the oldest transition is overwritten when full.
+    If path is given the arrays are memory mapped .npy files with that prefix, so they survive restarts. """
+
+    def __init__(self, capacity, prioritized=False, alpha=0.6, path=None):
+        self.capacity = capacity
+        self.size = 0
+        self.pos = 0
+        self.s = None
+        self.tree = SumTree(capacity) if prioritized else None
+        self.alpha = alpha
+        self.max_priority = 1.0
+        self.path = path
+
+    def storage(self, name, shape=None, dtype=None, mode='w+'):
+        if self.path is None:
+            return np.zeros(shape, dtype=dtype)
+        file_name = '{}_{}.npy'.format(self.path, name)
+        if mode == 'r+':
+            return np.lib.format.open_memmap(file_name, mode='r+')
+        return np.lib.format.open_memmap(file_name, mode='w+', shape=shape, dtype=dtype)
+
+    def allocate(self, dim, mode='w+'):
+        self.s = self.storage('s', (self.capacity, dim), np.float32, mode)
+        self.s_ = self.storage('s_', (self.capacity, dim), np.float32, mode)
+        self.a = self.storage('a', (self.capacity,), np.int64, mode)
+        self.r = self.storage('r', (self.capacity,), np.float32, mode)
+        self.done = self.storage('done', (self.capacity,), np.bool_, mode)
+        if self.tree is not None and self.path is not None:
+            self.tree.tree = self.storage('tree', self.tree.tree.shape, np.float64, mode)
+
+    def flush(self):
+        if self.path is None or self.s is None:
+            return
+        for array in (self.s, self.s_, self.a, self.r, self.done):
+            array.flush()
+        if self.tree is not None:
+            self.tree.tree.flush()
+
+    def state_dict(self):
+        return {'capacity': self.capacity, 'size': self.size, 'pos': self.pos, 'max_priority': self.max_priority,
+                'prioritized': self.tree is not None}
+
+    def load_state_dict(self, state):
+        if state['capacity'] != self.capacity or state['prioritized'] != (self.tree is not None):
+            raise ValueError('replay buffer of checkpoint has capacity {}, prioritized {}'.format(
+                state['capacity'], state['prioritized']))
+        if state['size'] > 0:
+            self.allocate(None, mode='r+')
+        self.size = state['size']
+        self.pos = state['pos']
+        self.max_priority = state['max_priority']
+
+    def add(self, s, a, r, done, s_):
+        if self.s is None:
+            self.allocate(len(s))
+        i = self.pos
+        self.s[i] = s
+        self.a[i] = a
+        self.r[i] = r
+        self.done[i] = done
+        self.s_[i] = s_
+        self.pos = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        if self.tree is not None:
+            self.tree.update(np.array([i]), self.max_priority ** self.alpha)
+
+    def sample(self, n, beta):
+        """ Returns (indices, importance weights) of n transitions, weights are None without priorities. """
+        if self.tree is None:
+            return np.fromiter(random.sample(range(self.size), n), dtype=np.int64, count=n), None
+        total = self.tree.total()
+        values = (np.arange(n) + np.random.random_sample(n)) * (total / n)
+        idx = np.minimum(self.tree.find(values), self.size - 1)
+        probs = self.tree.get(idx) / total
+        return idx, (self.size * probs) ** -beta
+
+    def update_priorities(self, idx, td_errors):
+        priorities = np.abs(td_errors) + 1e-6
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(idx, priorities ** self.alpha)
+
+
 class SampleBuffer:
-    def __init__(self, memory_size, batch_size):
+    def __init__(self, memory_size, batch_size, prioritized=False, alpha=0.6, beta=0.4, path=None):
         self.MEM_SIZE = memory_size
         self.BATCH_SIZE = batch_size
+        self.prioritized = prioritized
+        self.beta = beta
 
-        self.iter = 0
+        self.buf = ReplayRing(memory_size, prioritized, alpha, None if path is None else os.path.join(path, 'buf'))
+        self.main_buf = ReplayRing(memory_size, prioritized, alpha, None if path is None else os.path.join(path, 'main'))
+        self.last_batch = []
 
-        self.buf = []
-        self.main_buf = []
-        self.bf_rate = 0.4
+    def __len__(self):
+        return self.buf.size + self.main_buf.size
 
     def add_sample(self, s, a, r, done, s_):
         if not done:
-            self.buf.append([s, a, r, done, s_])
+            self.buf.add(s, a, r, done, s_)
         else:
-            self.main_buf.append([s, a, r, done, s_])
-
-        if len(self.buf) > self.MEM_SIZE:
-            self.buf.pop(0)
-        if len(self.main_buf) > self.MEM_SIZE:
-            self.main_buf.pop(0)
+            self.main_buf.add(s, a, r, done, s_)
 
     def sample(self):
-        if len(self.buf) + len(self.main_buf) <= 1:
-            return None, None, None, None, None
-        main_num = int(self.BATCH_SIZE * 0.1)
-        ano_num = self.BATCH_SIZE - main_num
-
-        if len(self.main_buf) > 0:
-            ft_main = random.sample(self.main_buf, min(main_num, len(self.main_buf)))
-        else:
-            ft_main = []
-
-        ano_num += main_num - len(ft_main)
-
-        ft = random.sample(self.buf, min(ano_num, len(self.buf)))
-        ft = ft + ft_main
-        return tuple(zip(*ft))
+        """ Samples a batch, 10% of it from transitions which solved the formula.
+
+        :return: tensors (states, actions, rewards, dones, next states, importance weights), actions, rewards,
+            dones and weights have shape (batch, 1), weights are None without prioritized replay
+        """
+        if len(self) <= 1:
+            return None, None, None, None, None, None
+        main_num = min(int(self.BATCH_SIZE * 0.1), self.main_buf.size)
+        ano_num = min(self.BATCH_SIZE - main_num, self.buf.size)
+
+        self.last_batch = []
+        parts = []
+        for ring, n in ((self.buf, ano_num), (self.main_buf, main_num)):
+            if n == 0:
+                continue
+            idx, weights = ring.sample(n, self.beta)
+            self.last_batch.append((ring, idx))
+            parts.append((ring.s[idx], ring.a[idx], ring.r[idx], ring.done[idx], ring.s_[idx], weights))
+
+        s, a, r, done, s_, weights = [list(column) for column in zip(*parts)]
+        batch = (torch.from_numpy(np.concatenate(s)),
+                 torch.from_numpy(np.concatenate(a)).unsqueeze(1),
+                 torch.from_numpy(np.concatenate(r)).unsqueeze(1),
+                 torch.from_numpy(np.concatenate(done)).unsqueeze(1),
+                 torch.from_numpy(np.concatenate(s_)))
+        if not self.prioritized:
+            return batch + (None,)
+        weights = np.concatenate(weights)
+        weights = torch.from_numpy((weights / weights.max()).astype(np.float32)).unsqueeze(1)
+        return batch + (weights,)
+
+    def flush(self):
+        self.buf.flush()
+        self.main_buf.flush()
+
+    def state_dict(self):
+        return {'buf': self.buf.state_dict(), 'main_buf': self.main_buf.state_dict()}
+
+    def load_state_dict(self, state):
+        self.buf.load_state_dict(state['buf'])
+        self.main_buf.load_state_dict(state['main_buf'])
+
+    def update_priorities(self, td_errors):
+        """ Sets priorities of the last sampled batch from its TD errors. """
+        td_errors = np.asarray(td_errors).reshape(-1)
+        start = 0
+        for ring, idx in self.last_batch:
+            ring.update_priorities(idx, td_errors[start:start + len(idx)])
+            start += len(idx)
 
 
 class DQN(nn.Module):
@@ -204,15 +411,19 @@ class DQN(nn.Module):
     def forward(self, input_data):
         return self.net(input_data)
 
-    def do_train(self, input_data, act, target):
+    def do_train(self, input_data, act, target, weights=None):
         self.train(True)
         output = self.forward(input_data)
 
         a_q_values = torch.gather(input=output, index=act, dim=1)
 
-        res_loss = self.loss(a_q_values, target)
+        if weights is None:
+            res_loss = self.loss(a_q_values, target)
+        else:
+            res_loss = (nn.functional.smooth_l1_loss(a_q_values, target, reduction='none') * weights).mean()
         print(res_loss)
         res_loss.backward()
+        return (a_q_values - target).detach()
 
     def predict(self, input_data):
         self.eval()
@@ -221,25 +432,130 @@ class DQN(nn.Module):
 
 
 class SMTSolver:
-    def __init__(self, tokenizer, enumerator):
+    def __init__(self, tokenizer, enumerator, cache=None, timeout=5, rlimit_budget=0, backend=None):
+        """ Initializes object of type SMTSolver.
+
+        :param cache: ResultCache or None
+        :param timeout: wall clock timeout of a solver call in seconds
+        :param rlimit_budget: z3 rlimit of a solver call, replaces the timeout when positive so that results
+                              do not depend on the load of the machine
+        :param backend: SolverPool running the calls with a hard deadline, a single worker pool if None
+        """
         self.enumerator = enumerator
         self.tokenizer = tokenizer
-        pass
+        self.cache = cache
+        self.timeout = timeout
+        self.rlimit_budget = rlimit_budget
+        self.backend = backend if backend is not None else SolverPool()
+
+    @staticmethod
+    def goal_hash(formula):
+        return goal_hash(formula)
+
+    def limits(self, timeout=None):
+        """ Returns (timeout in seconds, rlimit budget) of a solver call as recorded in cache keys,
+        0 stands for no limit. """
+        if self.rlimit_budget > 0:
+            return 0, int(self.rlimit_budget)
+        return (self.timeout if timeout is None else timeout), 0
+
+    def make_solver(self, tactic=None, timeout=None, cap=None):
+        """ Returns solver of tactic, or the default z3 solver if tactic is None, which runs within the limits
+        of a call. cap is an additional rlimit, e.g. the budget of adaptive capping. """
+        timeout, budget = self.limits(timeout)
+        if tactic is None:
+            s = z3.Solver()
+            if timeout > 0:
+                s.set('timeout', int(timeout * 1000))
+        else:
+            s = (z3.TryFor(tactic, int(timeout * 1000)) if timeout > 0 else tactic).solver()
+        if cap is not None and (budget == 0 or cap < budget):
+            # rlimit 0 would lift the limit
+            budget = max(int(cap), 1)
+        if budget > 0:
+            s.set('rlimit', budget)
+        return s
+
+    def cut_off(self, res, rlimit, cap):
+        """ Returns whether a call which used rlimit was stopped by its cap rather than by the limits of a call. """
+        if cap is None or (self.rlimit_budget > 0 and cap >= self.rlimit_budget):
+            return False
+        return res == 'unknown' and rlimit >= cap
+
+    def solve_cached(self, formula, tactic=None, timeout=None, cap=None):
+        """ Solves formula (goal or .smt2 file) with tactic, or with the default z3 solver if tactic is None.
+        Results of wrapped tactics and of the default solver are memoized in self.cache under the limits
+        they were obtained with.
+
+        :param cap: additional rlimit of the call, runs cut off by it are not memoized
+
+        :return: tuple (result, rlimit, time, output goal hash)
+        """
+        strategy = None
+        if tactic is None:
+            strategy = 'default'
+        elif isinstance(tactic, str):
+            strategy = tactic
+            tactic = z3.Tactic(tactic)
+        elif not isinstance(tactic, z3.Tactic):
+            strategy = tactic.to_smt2()
+            tactic = tactic.tactic
+
+        timeout, budget = self.limits(timeout)
+        key = None
+        if self.cache is not None and strategy is not None:
+            key = self.goal_hash(formula)
+            value = self.cache.get(key, strategy, timeout, budget)
+            if value is not None:
+                return value
 
-    @timeout_decorator.timeout(5, use_signals=False)
-    def try_to_solve_5(self, solver, formula):
-        solver.add(formula)
-        solver.check()
+        if isinstance(formula, str):
+            formula = z3.parse_smt2_file(formula)
+        s = self.make_solver(tactic, timeout, cap)
 
-    @timeout_decorator.timeout(10, use_signals=False)
-    def try_to_solve_10(self, solver, formula):
-        solver.add(formula)
-        solver.check()
+        s.add(formula)
+        r_before = self.get_rlimit(s)
+        t_before = time.time()
+        res = s.check()
+        t_after = time.time()
+        r_after = self.get_rlimit(s)
 
-    def solve_without_timeout(self, formula, tactic):
+        value = (str(res), r_after - r_before, t_after - t_before, self.goal_hash(s.assertions()))
+        if key is not None and not self.cut_off(value[0], value[1], cap):
+            self.cache.put(key, strategy, timeout, value, budget)
+        return value
+
+    def solve_in_backend(self, formula, tactic=None, timeout=5, keep_goal=False):
+        """ Solves formula with tactic (name, language object or Cond, None for the default z3 solver) in a worker
+        process of self.backend, which is interrupted after timeout seconds and killed if it does not stop.
+
+        :param keep_goal: whether the assertions of the solver are sent back, tactic has to be a single tactic
+        :raise TimeoutError: if the call did not finish in time
+        :raise z3.Z3Exception: if z3 rejected formula or tactic
+        :return: tuple (result, rlimit, time, resulting formula or None)
+        """
+        if isinstance(tactic, str):
+            tactic = objects.Tactic(tactic)
+        strategy = None if tactic is None else tactic.to_smt2()
+        res, rlimit, rtime, smt2 = self.backend.call(
+            _check_task, (to_smt2(formula), strategy, self.rlimit_budget, keep_goal), timeout)
+        return res, rlimit, rtime, (z3.parse_smt2_string(smt2) if smt2 is not None else None)
+
+    def try_to_solve_5(self, formula, tactic=None):
+        return self.solve_in_backend(formula, tactic, 5)[:3]
+
+    def try_to_solve_10(self, formula, tactic=None):
+        return self.solve_in_backend(formula, tactic, 10)[:3]
+
+    def close(self):
+        self.backend.close()
+
+    def solve_without_timeout(self, formula, tactic, cap=None):
         if type(tactic) is str:
             tactic = z3.Tactic(tactic)
         s = tactic.solver()
+        if cap is not None:
+            s.set('rlimit', max(int(cap), 1))
 
         s.check()
         r_before = self.get_rlimit(s)
@@ -253,7 +569,7 @@ class SMTSolver:
         # if isinstance(tactic, z3.Tactic) : print("true")
         return str(res), r_after - r_before, s.assertions()
 
-    def solve_with_tactic_seq(self, formula, tactics, collect_probs=False):
+    def solve_with_tactic_seq(self, formula, tactics, collect_probs=False, cap=None):
         if collect_probs:
             ps = [(i, z3.Probe(i)) for i in z3.probes()]
             pm = {i: set() for i in z3.probes()}
@@ -261,8 +577,7 @@ class SMTSolver:
             ps, pm = None, None
             if not collect_probs:
                 tac = objects.AndThen(*tactics) if len(tactics)>1 else tactics[0]
-                tac = z3.TryFor(tac.tactic, 5000)
-                s = tac.solver()
+                s = self.make_solver(tac.tactic, cap=cap)
                 s.check()
                 r_before = self.get_rlimit(s)
                 s.add(formula)
@@ -282,14 +597,23 @@ class SMTSolver:
         tactics.insert(0, z3.Tactic('skip'))
         tot_rlimit = 0
         res = 'unknown'
+        timeout, budget = self.limits()
 
         for tac in tactics:
             if not isinstance(tac, z3.Tactic):
                 tac = tac.tactic
-            tac = z3.TryFor(tac, 5000)
-            
-            res, rlimit, formula = self.solve_without_timeout(formula, tac)
-            tot_rlimit += rlimit
+            if timeout > 0:
+                tac = z3.TryFor(tac, int(timeout * 1000))
+
+            # every tactic gets the limits of a call, but no more than what is left of the cap of the sequence
+            step = budget if budget > 0 else None
+            if cap is not None:
+                if cap <= tot_rlimit:
+                    res = 'unknown'
+                    break
+                step = cap - tot_rlimit if step is None else min(step, cap - tot_rlimit)
+            res, step_rlimit, formula = self.solve_without_timeout(formula, tac, step)
+            tot_rlimit += step_rlimit
             feather_probs(formula)
 
         return str(res), tot_rlimit, formula, pm
@@ -297,14 +621,13 @@ class SMTSolver:
     def solve(self, formula, tactic):
         if type(tactic) is str:
             tactic = z3.Tactic(tactic)
-        tactic = z3.TryFor(tactic, 5000)
-        s = tactic.solver()
+        s = self.make_solver(tactic)
         '''
         try:
             # print('try begin')
-            self.try_to_solve_5(s, formula)
+            self.try_to_solve_5(formula, tactic)
             # print('try success')
-        except timeout_decorator.timeout_decorator.TimeoutError as e:
+        except TimeoutError as e:
             # print('timeout')
             return None, 'unknown', 1000000, 100000, None, formula
         '''
@@ -325,30 +648,27 @@ class SMTSolver:
         rlimit = r_after - r_before
         rtime = t_after - t_before
 
+        bow = self.tokenizer.bow(formula)
         g = z3.Goal()
         g.add(formula)
-        s1 = self.get_probs(g) + self.tokenizer.bow(formula.sexpr())
+        s1 = self.get_probs(g) + bow
         g = z3.Goal()
         g.add(s.assertions())
 
-        s_ = self.get_probs(g) + self.tokenizer.bow(formula.sexpr())
+        s_ = self.get_probs(g) + bow
 
         return s1, res, rlimit, rtime * 1000, s_, s.assertions()
 
     @staticmethod
     def get_probs(goal):
-        probs = [z3.Probe(p) for p in z3.probes()]
-        ng = goal.as_expr()
-        probs = [p(ng) for p in probs]
-        return probs
-
-    def solve_dataset(self, formulas, tactic, timeout=5):
-        tactic = z3.TryFor(tactic, timeout * 1000)
-        solver = tactic.solver()
+        return default_features().features(goal.as_expr()).tolist()
 
+    def solve_dataset(self, formulas, tactic, timeout=None):
         unsolved = 0
         tot_rlimit = 0
         for formula in formulas:
+            # a fresh solver per file, reset() keeps the logic of the previous file
+            solver = self.make_solver(tactic, timeout)
             solver.check()
             r_before = self.get_rlimit(solver)
             solver.from_file(formula)
@@ -358,7 +678,6 @@ class SMTSolver:
             else:
                 r_after = self.get_rlimit(solver)
                 tot_rlimit += r_after - r_before
-            solver.reset()
 
         return unsolved, tot_rlimit
 
@@ -370,48 +689,35 @@ class SMTSolver:
                 return stats[i][1]
         return 0
 
-    @timeout_decorator.timeout(30, use_signals=False)
-    def solve_by_z3(self, formula):
+    def solve_by_z3(self, formula, timeout=30):
         # formula = z3.parse_smt2_file(smt_instance)
-        s = z3.Solver()
-        s.check()
-        before = self.get_rlimit(s)
-        s.add(formula)
-        t_before = time.time()
-        res = s.check()
-        t_after = time.time()
-        print("z3: ", res, self.get_rlimit(s) - before, t_after - t_before)
+        res, rlimit, rtime, _ = self.solve_in_backend(formula, None, timeout)
+        print("z3: ", res, rlimit, rtime)
 
-    @timeout_decorator.timeout(30, use_signals=False)
-    def solve_by_tactic(self, formula, tactic):
-        if type(tactic) is not z3.Tactic:
-            tactic = tactic.tactic
-        s = tactic.solver()
-        s.check()
-        r_before = self.get_rlimit(s)
-        s.add(formula)
-        t_before = time.time()
-        res = s.check()
-        t_after = time.time()
-        print("predict: ", res, self.get_rlimit(s) - r_before, t_after - t_before)
+    def solve_by_tactic(self, formula, tactic, timeout=30):
+        res, rlimit, rtime, _ = self.solve_in_backend(formula, tactic, timeout)
+        print("predict: ", res, rlimit, rtime)
 
-    def solve_goal(self, formula, tac, use_rlimit=False, timeout=5):
+    def solve_goal(self, formula, tac, use_rlimit=False, timeout=None, cap=None):
+        """ Applies tac to formula and returns (result, cost, resulting formula), cost is rlimit if use_rlimit
+        else time. The rlimit budget and cap only apply when measuring rlimit, tactics applied to goals
+        directly can only be limited by the timeout. """
         g = z3.Goal()
         g.add(formula)
         if isinstance(tac, str):
             tac = z3.Tactic(tac)
         if not isinstance(tac, z3.Tactic):
             tac = tac.tactic
-        tac = z3.TryFor(tac, timeout * 1000)
-        gs = tac.solver()
 
         if use_rlimit:
+            gs = self.make_solver(tac, timeout, cap)
             gs.add(formula)
             r_before = self.get_rlimit(gs)
             res = gs.check()
             r_after = self.get_rlimit(gs)
             return res, r_after-r_before, gs.assertions()
 
+        tac = z3.TryFor(tac, int((self.timeout if timeout is None else timeout) * 1000))
         t_before = time.time()
         g = tac(g)
         t_after = time.time()
@@ -420,10 +726,227 @@ class SMTSolver:
         return str(s.check()), t_after - t_before, g[0].as_expr()
 
 
+class TacticEnv:
+    """ Training environment of a single formula, keeps the current goal between tactic applications. """
+
+    def __init__(self, solver):
+        self.solver = solver
+        self.formula = None
+
+    def reset(self, instance):
+        formula = z3.parse_smt2_file(instance)
+        s, _, _, _, _, self.formula = self.solver.solve(formula, 'skip')
+        return s
+
+    def step(self, act):
+        try:
+            s, res, rlimit, rtime, s_, self.formula = self.solver.solve(self.formula, z3.Tactic(act))
+        except z3.z3types.Z3Exception:
+            return None, 'unknown', 1000000, 5000, None
+        return s, res, rlimit, rtime, s_
+
+
+def _script_rlimit(out):
+    for line in out.split('\n'):
+        if ':rlimit-count' in line:
+            return int(line.split()[-1].rstrip(')'))
+    return 0
+
+
+def _check_task(smt2, strategy, budget, keep_goal):
+    """ Solves SMT2 script smt2 with strategy (tactic in SMT2 format, None for the default z3 solver) within
+    rlimit budget, runs in a worker process of SolverPool. """
+    if keep_goal:
+        # the goal left by the tactic is only accessible through the API, which can only build named tactics
+        formula = z3.parse_smt2_string(smt2)
+        s = z3.Solver() if strategy is None else z3.Tactic(strategy).solver()
+        if budget > 0:
+            s.set('rlimit', int(budget))
+        s.check()
+        r_before = SMTSolver.get_rlimit(s)
+        s.add(formula)
+        t_before = time.time()
+        res = s.check()
+        t_after = time.time()
+        r_after = SMTSolver.get_rlimit(s)
+        return str(res), r_after - r_before, t_after - t_before, to_smt2(s.assertions())
+
+    # any strategy, Cond included, can be run by check-sat-using of a script; the script state lives in the
+    # main context, so the worker can interrupt it, and the rlimit count of the context is only ever growing
+    ctx = z3.main_ctx().ref()
+    script = '(reset)\n(set-option :rlimit {})\n(check-sat)\n(get-info :all-statistics)'.format(int(budget))
+    r_before = _script_rlimit(z3.Z3_eval_smtlib2_string(ctx, script))
+    z3.Z3_eval_smtlib2_string(ctx, smt2.replace('(check-sat)', ''))
+    cmd = '(check-sat)' if strategy is None else '(check-sat-using {})'.format(strategy)
+    t_before = time.time()
+    out = z3.Z3_eval_smtlib2_string(ctx, cmd + '\n(get-info :all-statistics)')
+    t_after = time.time()
+    return out.split('\n')[0].strip(), _script_rlimit(out) - r_before, t_after - t_before, None
+
+
+def _env_worker(conn, tactics_config, rlimit_budget=0, ast_bow=False):
+    tokenizer = GoalTokenizer(ast_bow)
+    env = TacticEnv(SMTSolver(tokenizer, StrategyEnumerator(**tactics_config), rlimit_budget=rlimit_budget))
+    while True:
+        cmd, arg = conn.recv()
+        if cmd == 'close':
+            break
+        conn.send(getattr(env, cmd)(arg))
+    conn.close()
+
+
+class VecEnv:
+    """ K training environments stepped together. With a single environment the z3 work is done in the
+    calling process, otherwise every environment lives in its own worker process. """
+
+    def __init__(self, solver, tactics_config, num_envs=1):
+        self.num_envs = max(num_envs, 1)
+        self.local = None
+        self.conns = []
+        self.procs = []
+        if self.num_envs == 1:
+            self.local = TacticEnv(solver)
+            return
+        ctx = parallel.get_context()
+        for _ in range(self.num_envs):
+            conn, child_conn = ctx.Pipe()
+            p = ctx.Process(target=_env_worker, args=(child_conn, tactics_config, solver.rlimit_budget,
+                                                      solver.tokenizer.ast_bow),
+                            daemon=True)
+            p.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.procs.append(p)
+
+    def call(self, requests):
+        """ Runs requests {env index: (method, argument)} on all environments at once.
+
+        :return: dictionary {env index: result}
+        """
+        if self.local is not None:
+            return {env_i: getattr(self.local, cmd)(arg) for env_i, (cmd, arg) in requests.items()}
+        for env_i, request in requests.items():
+            self.conns[env_i].send(request)
+        return {env_i: self.conns[env_i].recv() for env_i in requests}
+
+    def close(self):
+        for conn, p in zip(self.conns, self.procs):
+            conn.send(('close', None))
+            p.join()
+            conn.close()
+        self.conns, self.procs = [], []
+
+
+class Episode:
+    """ Per environment state of one training episode. """
+
+    def __init__(self, ins_i, instance, ep_i, max_steps, all_tactics):
+        self.ins_i = ins_i
+        self.instance = instance
+        self.ep_i = ep_i
+        self.max_steps = max_steps
+        self.steps = 0
+        self.reward = 0
+        self.tac_memory = {tac: 0 for tac in all_tactics}
+        self.lst_tactic = []
+        self.tac_seq = []
+        self.loop = False
+        self.done = False
+        self.solved = False
+        self.s = None
+
+
+class QueueBuffer:
+    """ Replay buffer of an actor process, forwards every sample to the learner. """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def add_sample(self, s, a, r, done, s_):
+        self.queue.put(('sample', (s, a, r, done, s_)))
+
+
+def _actor_worker(agent_args, agent_kwargs, r_denominator, shared_net, lock, version, tasks, results):
+    torch.set_num_threads(1)
+    agent = Agent(*agent_args, **agent_kwargs)
+    agent.r_denominator = r_denominator
+    agent.buf = QueueBuffer(results)
+    env = TacticEnv(agent.solver)
+    seen = -1
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        ins_i, instance, ep_i, max_steps = task
+        print('===try to solve {}th formula: '.format(ins_i), instance)
+        episode = Episode(ins_i, instance, ep_i, max_steps, agent.enumerator.all_tactics)
+        episode.s = env.reset(instance) + list(episode.tac_memory.values())
+        while not episode.done and agent.next_step(episode):
+            if version.value != seen:
+                with lock:
+                    seen = version.value
+                    agent.online_net.load_state_dict(shared_net.state_dict())
+            with torch.no_grad():
+                wait = agent.online_net.predict(torch.as_tensor([episode.s]))[0]
+            act = agent.choose_tactic(wait, episode)
+            agent.observe(episode, act, env.step(act))
+        results.put(('episode', episode))
+
+
+class ActorPool:
+    """ Actor processes which explore formulas with the last published weights of online_net and stream
+    their transitions back to the learner. """
+
+    def __init__(self, agent, num_actors):
+        ctx = parallel.get_context()
+        self.shared_net = DQN(118, len(agent.enumerator.all_tactics))
+        self.shared_net.load_state_dict(agent.online_net.state_dict())
+        self.shared_net.share_memory()
+        self.lock = ctx.Lock()
+        self.version = ctx.Value('i', 0)
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+
+        agent_args = (agent.config, agent.episode_cnt, agent.step_cnt, agent.rand_num, agent.exp_name, None)
+        agent_kwargs = {'use_rlimit': agent.use_rlimit, 'rlimit_budget': agent.solver.rlimit_budget,
+                        'ast_bow': agent.tokenizer.ast_bow}
+        args = (agent_args, agent_kwargs, agent.r_denominator, self.shared_net, self.lock, self.version, self.tasks, self.results)
+        self.procs = [ctx.Process(target=_actor_worker, args=args, daemon=True) for _ in range(num_actors)]
+        for p in self.procs:
+            p.start()
+
+    def publish(self, net):
+        with self.lock:
+            self.shared_net.load_state_dict(net.state_dict())
+            self.version.value += 1
+
+    def submit(self, task):
+        self.tasks.put(task)
+
+    def get(self):
+        while True:
+            try:
+                return self.results.get(timeout=5)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self.procs):
+                    raise RuntimeError('actor process exited unexpectedly')
+
+    def close(self):
+        for _ in self.procs:
+            self.tasks.put(None)
+        for p in self.procs:
+            p.join()
+        self.procs = []
+
+
 class Agent:
-    def __init__(self, config, episode_cnt, step_cnt, rand_tactic_num, exp_name, out_file):
+    def __init__(self, config, episode_cnt, step_cnt, rand_tactic_num, exp_name, out_file, result_cache=None,
+                 num_envs=1, train_every=1, num_actors=0, memory_size=2000, prioritized=False,
+                 checkpoint_dir=None, checkpoint_every=10, baseline=None, baseline_workers=1, use_rlimit=False,
+                 rlimit_budget=0, ast_bow=False):
+        self.config = config
         self.enumerator = StrategyEnumerator(**config["tactics_config"])
-        self.tokenizer = GoalTokenizer()
+        self.tokenizer = GoalTokenizer(ast_bow)
 
         self.online_net = DQN(118, len(self.enumerator.all_tactics))
         self.target_net = DQN(118, len(self.enumerator.all_tactics))
@@ -431,8 +954,17 @@ class Agent:
         self.optimizer = torch.optim.Adam(self.online_net.parameters(), lr=0.001)
         # self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, 100, gamma=0.9)
 
-        self.buf = SampleBuffer(2000, 100)
-        self.solver = SMTSolver(self.tokenizer, self.enumerator)
+        self.baseline = baseline
+        self.baseline_workers = baseline_workers
+        self.use_rlimit = use_rlimit
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        replay_path = None
+        if checkpoint_dir is not None:
+            replay_path = os.path.join(checkpoint_dir, 'replay')
+            os.makedirs(replay_path, exist_ok=True)
+        self.buf = SampleBuffer(memory_size, 100, prioritized, path=replay_path)
+        self.solver = SMTSolver(self.tokenizer, self.enumerator, result_cache, rlimit_budget=rlimit_budget)
 
         self.episode_cnt = episode_cnt
         self.rand_num = rand_tactic_num
@@ -440,6 +972,18 @@ class Agent:
         self.gamma = 0.5
         self.step_cnt = step_cnt
         self.trans_cnt = 200
+        self.num_envs = num_envs
+        self.train_every = train_every
+        self.num_actors = num_actors
+        self.publish_cnt = 10
+
+        self.turn_cnt = 0
+        self.last_trans = 0
+        self.train_credit = 0
+        self.update_cnt = 0
+        self.ep_i = 0
+        self.remaining = []
+        self.finished_cnt = 0
 
         self.exp_name = exp_name
         self.best_strategy = {}
@@ -450,162 +994,297 @@ class Agent:
         # smt_instances = random.sample(smt_instances, int(len(smt_instances) / 2))
         tot_r = 0
         print("=================start to initial denominator:")
-        # r_list = []
-        for smt_i, smt_instance in enumerate(smt_instances):
-            if smt_i % 5 == 0:
-                print("evaluate {}th formula".format(smt_i))
-            formula = z3.parse_smt2_file(smt_instance)
-            try:
-                s = z3.Solver()
-                self.solver.try_to_solve_5(s, formula)
-                s = z3.Solver()
-                if use_rlimit:
-                    s.check()
-                    s.add(formula)
-                    r_before = self.solver.get_rlimit(s)
-                else:
-                    s.add(formula)
-                    r_before = time.time()
-                
-                s.check()
-
-                if use_rlimit:
-                    r_after = self.solver.get_rlimit(s)
-                else:
-                    r_after = time.time()
-                tot_r += r_after - r_before
-            except timeout_decorator.timeout_decorator.TimeoutError:
+        timeout, budget = self.solver.limits()
+        baseline = compute_baseline(smt_instances, timeout, self.baseline, self.baseline_workers, budget)
+        for smt_instance in smt_instances:
+            res, rlimit, rtime = baseline[smt_instance]
+            if use_rlimit:
+                tot_r += rlimit
+            elif res == 'unknown':
                 tot_r += 6
-        avg_r = tot_r * 1000 / len(smt_instances)
+            else:
+                tot_r += rtime
+        avg_r = tot_r / len(smt_instances) if use_rlimit else tot_r * 1000 / len(smt_instances)
         self.r_denominator = avg_r / 10
         print("======================construct result:", avg_r / 10)
 
     def train(self, smt_instances, record_best=False):
-        self.construct_denominator(smt_instances)
-        self.target_net.load_state_dict(self.online_net.state_dict())
+        resumed = self.load_checkpoint()
+        if not resumed:
+            self.construct_denominator(smt_instances, self.use_rlimit)
+            self.target_net.load_state_dict(self.online_net.state_dict())
         if record_best:
-            self.best_strategy = {instance: (-1e12, []) for instance in smt_instances}
-        turn_cnt = 0
-        for ep_i in range(self.episode_cnt):
-            print("================ep:%d====================" % ep_i)
-            for ins_i in range(len(smt_instances)):
-                for repeat_i in range(3 if ep_i < self.episode_cnt-1 else 1):
-                    instance = smt_instances[ins_i]
-                    formula = z3.parse_smt2_file(instance)
-                    s, _, _, _, s_, formula = self.solver.solve(formula, 'skip')
-
-                    episode_reward = 0
-                    tac_memory = {tac: 0 for tac in self.enumerator.all_tactics}
-                    s = s + list(tac_memory.values())
-                    lst_tactic = []
-                    tac_seq = []
-                    loop = False
-
-                    print('===try to solve {}th formula: '.format(ins_i), smt_instances[ins_i])
-                    for st_i in range(self.step_cnt if ep_i > 0 else self.step_cnt * 2):
-                        turn_cnt += 1
-
-                        if len(lst_tactic) == len(self.enumerator.all_tactics):
-                            break
-
-                        tensor_s = torch.as_tensor(s).unsqueeze(0)
-                        wait = self.online_net.predict(tensor_s)[0]
-                        # print(wait)
-
-                        if ep_i < self.rand_num:
-                            act = random.choice(self.enumerator.all_tactics)
-                            while loop and act in lst_tactic:
-                                act = random.choice(self.enumerator.all_tactics)
-                        elif ep_i < self.episode_cnt-1:
-                            wait = wait.sub(torch.min(wait)).add_(0.5)
-                            torch.manual_seed(int(random.random() * 100000))
-                            wait = nn.functional.normalize(wait, dim=0)
-                            while wait[torch.argmin(wait)] < 0:
-                                wait[torch.argmin(wait)] = 0.0
-                            act = self.find_tactic(torch.multinomial(wait, 1)[0])
-                            while loop and act in lst_tactic:
-                                wait[torch.argmax(wait)] = -10000
-                                act = self.find_tactic(int(torch.argmax(wait)))
-                        else:
-                            act = self.find_tactic(int(torch.argmax(wait)))
-
-                        tac = z3.Tactic(act)
-
-                        ind = self.enumerator.all_tactics.index(act)
-                        ori_s = s
-
-                        try:
-                            s, res, rlimit, rtime, s_, formula = self.solver.solve(formula, tac)
-                        except z3.z3types.Z3Exception:
-                            s, res, rlimit, rtime, s_ = None, 'unknown', 1000000, 5000, None
-
-                        if s is None or rlimit == 0:
-                            s, s_ = ori_s, ori_s
-                        else:
-                            s = s + list(tac_memory.values())
-
-                        if res == 'unknown' and s == s_:
-                            loop = True
-                            lst_tactic.append(act)
-                            self.buf.add_sample(s, ind, -10, True if res != 'unknown' else False, s_)
-                            continue
-                        else:
-                            episode_reward -= rtime
-                            bias = 20 - tac_memory[act] * 10
-                            bias = max(bias, -10)
-                            tac_seq.append(act)
-                            tac_memory[act] += 1
-                            s_ = s_ + list(tac_memory.values())
-                            print(str(act))
-
-                        loop = False
-                        lst_tactic.clear()
-
-                        bias += 0 if res == 'unknown' else 20
-                        # print(rtime, bias, self.r_denominator)
-                        if len(s) == len(s_):
-                            self.buf.add_sample(s, ind, bias - rtime / self.r_denominator, True if res != 'unknown' else False, s_)
-
-                        self.logging.info('%d: %d' % (ep_i, episode_reward))
-
-                        batch_s, batch_a, batch_r, batch_res, batch_s_ = self.buf.sample()
-                        # print(torch.as_tensor(batch_s_))
-                        # print(batch_r)
-                        if batch_s is not None:
-                            target_q_values = self.target_net(torch.as_tensor(batch_s_))
-                            target_max_values = target_q_values.max(dim=1, keepdim=True)[0]
-                            # print(target_max_values)
-                            # print(batch_r)
-
-                            targets = torch.transpose(torch.as_tensor([batch_r]), 1, 0) + self.gamma * target_max_values
-                            # print(targets)
-                            
-
-                            self.optimizer.zero_grad()
-                            self.online_net.do_train(torch.as_tensor(batch_s),
-                                                     torch.transpose(torch.as_tensor([batch_a]), 1, 0), targets)
-                            self.optimizer.step()
-                        # print("step done")
-                        if res != 'unknown':
-                            if record_best and self.best_strategy[instance][0] < episode_reward:
-                                self.best_strategy[instance] = (episode_reward, tac_seq)
-                            print('formula solved!')
-                            break
-
-                    if turn_cnt % self.trans_cnt == 0:
-                        self.target_net.load_state_dict(self.online_net.state_dict())
-                        print('ep:%d change model success; reward: %d' % (ep_i, episode_reward))
-                    else:
-                        print('ep:%d is done; reward: %d' % (ep_i, episode_reward))
-
-            print("================ep:%d====================" % ep_i)
-            self.output_best_strategy()
-            torch.save(self.online_net.state_dict(), 'cache/model/{}_{}_5.pth'.format(self.exp_name, ep_i))
-
-
-    @timeout_decorator.timeout(30, use_signals=False)
-    def predict(self, formula, random_select=False):
+            for instance in smt_instances:
+                self.best_strategy.setdefault(instance, (-1e12, []))
+        if self.num_actors > 0:
+            envs = ActorPool(self, self.num_actors)
+        else:
+            envs = VecEnv(self.solver, self.config["tactics_config"], self.num_envs)
+        try:
+            for ep_i in range(self.ep_i, self.episode_cnt):
+                print("================ep:%d====================" % ep_i)
+                if resumed and ep_i == self.ep_i and len(self.remaining) > 0:
+                    episodes = list(self.remaining)
+                else:
+                    episodes = []
+                    for ins_i in range(len(smt_instances)):
+                        for repeat_i in range(3 if ep_i < self.episode_cnt-1 else 1):
+                            episodes.append((ins_i, smt_instances[ins_i]))
+                self.ep_i = ep_i
+                self.remaining = list(episodes)
+                if self.num_actors > 0:
+                    self.learn_episodes(envs, episodes, ep_i, record_best)
+                else:
+                    self.run_episodes(envs, episodes, ep_i, record_best)
+
+                print("================ep:%d====================" % ep_i)
+                self.output_best_strategy()
+                torch.save(self.online_net.state_dict(), 'cache/model/{}_{}_5.pth'.format(self.exp_name, ep_i))
+                self.ep_i, self.remaining = ep_i + 1, []
+                self.save_checkpoint()
+        finally:
+            envs.close()
+
+    def run_episodes(self, envs, episodes, ep_i, record_best):
+        """ Runs episodes [(instance index, instance)] on all environments of envs. States of all running
+        episodes are evaluated by a single forward pass, online_net is updated once per self.train_every
+        applied tactics. """
+        all_tactics = self.enumerator.all_tactics
+        max_steps = self.step_cnt if ep_i > 0 else self.step_cnt * 2
+        pending = list(episodes)
+        running = {}
+        free = list(range(envs.num_envs))
+
+        while len(pending) > 0 or len(running) > 0:
+            resets = {}
+            while len(free) > 0 and len(pending) > 0:
+                env_i = free.pop(0)
+                ins_i, instance = pending.pop(0)
+                print('===try to solve {}th formula: '.format(ins_i), instance)
+                running[env_i] = Episode(ins_i, instance, ep_i, max_steps, all_tactics)
+                resets[env_i] = ('reset', instance)
+            for env_i, s in envs.call(resets).items():
+                episode = running[env_i]
+                episode.s = s + list(episode.tac_memory.values())
+
+            acts = {}
+            for env_i, episode in running.items():
+                if self.next_step(episode):
+                    acts[env_i] = None
+
+            if len(acts) > 0:
+                with torch.no_grad():
+                    waits = self.online_net.predict(torch.as_tensor([running[env_i].s for env_i in acts]))
+                for wait, env_i in zip(waits, list(acts.keys())):
+                    acts[env_i] = self.choose_tactic(wait, running[env_i])
+
+                results = envs.call({env_i: ('step', act) for env_i, act in acts.items()})
+                for env_i, act in acts.items():
+                    if self.observe(running[env_i], act, results[env_i]):
+                        self.train_credit += 1
+
+                while self.train_credit >= self.train_every:
+                    self.train_credit -= self.train_every
+                    self.update()
+
+            for env_i in [env_i for env_i, episode in running.items() if episode.done]:
+                self.end_episode(running.pop(env_i), record_best)
+                free.append(env_i)
+            free.sort()
+
+    def learn_episodes(self, actors, episodes, ep_i, record_best):
+        """ Hands episodes [(instance index, instance)] to the actor processes and trains online_net on the
+        transitions they send back, once per self.train_every transitions. Weights are published to the actors
+        every self.publish_cnt updates. """
+        max_steps = self.step_cnt if ep_i > 0 else self.step_cnt * 2
+        actors.publish(self.online_net)
+        for ins_i, instance in episodes:
+            actors.submit((ins_i, instance, ep_i, max_steps))
+
+        remaining = len(episodes)
+        while remaining > 0:
+            kind, value = actors.get()
+            if kind == 'sample':
+                self.buf.add_sample(*value)
+                self.train_credit += 1
+                while self.train_credit >= self.train_every:
+                    self.train_credit -= self.train_every
+                    self.update()
+                    self.update_cnt += 1
+                    if self.update_cnt % self.publish_cnt == 0:
+                        actors.publish(self.online_net)
+            else:
+                self.turn_cnt += value.steps
+                self.end_episode(value, record_best)
+                remaining -= 1
+
+    def next_step(self, episode):
+        """ Advances step counter of episode, returns False if the episode is over. """
+        if episode.steps == episode.max_steps:
+            episode.done = True
+            return False
+        episode.steps += 1
+        self.turn_cnt += 1
+        if len(episode.lst_tactic) == len(self.enumerator.all_tactics):
+            episode.done = True
+            return False
+        return True
+
+    def end_episode(self, episode, record_best):
+        if record_best and episode.solved and self.best_strategy[episode.instance][0] < episode.reward:
+            self.best_strategy[episode.instance] = (episode.reward, episode.tac_seq)
+        if self.turn_cnt - self.last_trans >= self.trans_cnt:
+            self.last_trans = self.turn_cnt
+            self.target_net.load_state_dict(self.online_net.state_dict())
+            print('ep:%d change model success; reward: %d' % (episode.ep_i, episode.reward))
+        else:
+            print('ep:%d is done; reward: %d' % (episode.ep_i, episode.reward))
+
+        self.remaining.remove((episode.ins_i, episode.instance))
+        self.finished_cnt += 1
+        if self.finished_cnt % self.checkpoint_every == 0:
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        """ Saves the whole training state into self.checkpoint_dir. Transitions are kept in the memory mapped
+        replay files, the checkpoint only records their fill state. Episodes which were running are started
+        again after a resume. """
+        if self.checkpoint_dir is None:
+            return
+        self.buf.flush()
+        np_state = np.random.get_state()
+        state = {
+            'online_net': self.online_net.state_dict(),
+            'target_net': self.target_net.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'buf': self.buf.state_dict(),
+            'best_strategy': self.best_strategy,
+            'r_denominator': self.r_denominator,
+            'counters': (self.turn_cnt, self.last_trans, self.train_credit, self.update_cnt, self.finished_cnt),
+            'ep_i': self.ep_i,
+            'remaining': self.remaining,
+            'random': random.getstate(),
+            'np_random': (np_state[0], np_state[1].tolist()) + tuple(np_state[2:]),
+            'torch_random': torch.get_rng_state(),
+        }
+        path = os.path.join(self.checkpoint_dir, 'checkpoint.pth')
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def load_checkpoint(self):
+        """ Restores the training state saved by save_checkpoint, returns False if there is none. """
+        if self.checkpoint_dir is None:
+            return False
+        path = os.path.join(self.checkpoint_dir, 'checkpoint.pth')
+        if not os.path.exists(path):
+            return False
+        state = torch.load(path)
+        self.online_net.load_state_dict(state['online_net'])
+        self.target_net.load_state_dict(state['target_net'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.buf.load_state_dict(state['buf'])
+        self.best_strategy = state['best_strategy']
+        self.r_denominator = state['r_denominator']
+        self.turn_cnt, self.last_trans, self.train_credit, self.update_cnt, self.finished_cnt = state['counters']
+        self.ep_i = state['ep_i']
+        self.remaining = state['remaining']
+        random.setstate(state['random'])
+        np_state = state['np_random']
+        np.random.set_state((np_state[0], np.array(np_state[1], dtype=np.uint32)) + tuple(np_state[2:]))
+        torch.set_rng_state(state['torch_random'])
+        print("======================resume from checkpoint: ep {}, {} episodes left, {} transitions".format(
+            self.ep_i, len(self.remaining), len(self.buf)))
+        return True
+
+    def choose_tactic(self, wait, episode):
+        ep_i = episode.ep_i
+        if ep_i < self.rand_num:
+            act = random.choice(self.enumerator.all_tactics)
+            while episode.loop and act in episode.lst_tactic:
+                act = random.choice(self.enumerator.all_tactics)
+        elif ep_i < self.episode_cnt-1:
+            wait = wait.sub(torch.min(wait)).add_(0.5)
+            torch.manual_seed(int(random.random() * 100000))
+            wait = nn.functional.normalize(wait, dim=0)
+            while wait[torch.argmin(wait)] < 0:
+                wait[torch.argmin(wait)] = 0.0
+            act = self.find_tactic(torch.multinomial(wait, 1)[0])
+            while episode.loop and act in episode.lst_tactic:
+                wait[torch.argmax(wait)] = -10000
+                act = self.find_tactic(int(torch.argmax(wait)))
+        else:
+            act = self.find_tactic(int(torch.argmax(wait)))
+        return act
+
+    def observe(self, episode, act, result):
+        """ Records outcome of applying act in episode into the replay buffer.
+
+        :return: True if the step counts towards a gradient update
+        """
+        s, res, rlimit, rtime, s_ = result
+        cost = rlimit if self.use_rlimit else rtime
+        ind = self.enumerator.all_tactics.index(act)
+        ori_s = episode.s
+        tac_memory = episode.tac_memory
+
+        if s is None or rlimit == 0:
+            s, s_ = ori_s, ori_s
+        else:
+            s = s + list(tac_memory.values())
+        episode.s = s
+
+        if res == 'unknown' and s == s_:
+            episode.loop = True
+            episode.lst_tactic.append(act)
+            self.buf.add_sample(s, ind, -10, True if res != 'unknown' else False, s_)
+            return False
+
+        episode.reward -= cost
+        bias = 20 - tac_memory[act] * 10
+        bias = max(bias, -10)
+        episode.tac_seq.append(act)
+        tac_memory[act] += 1
+        s_ = s_ + list(tac_memory.values())
+        print(str(act))
+
+        episode.loop = False
+        episode.lst_tactic.clear()
+
+        bias += 0 if res == 'unknown' else 20
+        if len(s) == len(s_):
+            self.buf.add_sample(s, ind, bias - cost / self.r_denominator, True if res != 'unknown' else False, s_)
+
+        self.logging.info('%d: %d' % (episode.ep_i, episode.reward))
+
+        if res != 'unknown':
+            print('formula solved!')
+            episode.solved = True
+            episode.done = True
+        return True
+
+    def update(self):
+        batch_s, batch_a, batch_r, batch_res, batch_s_, weights = self.buf.sample()
+        if batch_s is None:
+            return
+        with torch.no_grad():
+            target_q_values = self.target_net(batch_s_)
+            target_max_values = target_q_values.max(dim=1, keepdim=True)[0]
+        targets = batch_r + self.gamma * target_max_values
+
+        self.optimizer.zero_grad()
+        td_errors = self.online_net.do_train(batch_s, batch_a, targets, weights)
+        self.optimizer.step()
+        if weights is not None:
+            self.buf.update_priorities(td_errors.numpy())
+
+    def predict(self, formula, random_select=False, timeout=30):
+        """ Applies the tactics chosen by online_net to formula until it is solved, every tactic runs in the
+        solver backend with what is left of timeout seconds.
+
+        :raise TimeoutError: if formula is not solved in time
+        """
         print('try to predict:')
+        deadline = time.time() + timeout
 
         tot_rlimit = 0
 
@@ -619,7 +1298,7 @@ class Agent:
         for i in range(30):
             g = z3.Goal()
             g.add(formula)
-            s = self.solver.get_probs(g) + self.tokenizer.bow(formula.sexpr()) + list(tac_memory.values())
+            s = self.solver.get_probs(g) + self.tokenizer.bow(formula) + list(tac_memory.values())
             a = self.online_net.predict(torch.as_tensor(s).unsqueeze(0))
             print(a)
             if random_select:
@@ -634,7 +1313,9 @@ class Agent:
                 act = 'simplify'
             print("try to use", act)
 
-            res, rlimit, n_formula = self.solver.solve_without_timeout(formula, act)
+            if time.time() >= deadline:
+                raise TimeoutError('prediction did not finish in {} seconds'.format(timeout))
+            res, rlimit, _, n_formula = self.solver.solve_in_backend(formula, act, deadline - time.time(), True)
             if s is None:
                 print('failed')
                 return
@@ -642,7 +1323,7 @@ class Agent:
             print(act, rlimit)
             tot_rlimit += rlimit
             tac_memory[act] += 1
-            if random_select and str(n_formula) == str(formula) and res == 'unknown':
+            if random_select and goal_fingerprint(n_formula) == goal_fingerprint(formula) and res == 'unknown':
                 tot_rlimit -= rlimit
             else:
                 tactic_seq.append(act)
@@ -657,8 +1338,7 @@ class Agent:
     def extract_tactics(self, eva_tuples):
         for instance, r, tac in eva_tuples:
             formula = z3.parse_smt2_file(instance)
-            s1 = z3.Solver()
-            s2 = z3.TryFor(tac.tactic, 5000).solver()
+            s2 = self.solver.make_solver(tac.tactic)
 
             def get_check_time(s):
                 s.check()
@@ -672,10 +1352,8 @@ class Agent:
 
             res, r2, t2 = get_check_time(s2)
             try:
-                self.solver.try_to_solve_5(s1, formula)
-                s1 = z3.Solver()
-                _, r1, t1 = get_check_time(s1)
-            except timeout_decorator.timeout_decorator.TimeoutError:
+                _, r1, t1 = self.solver.try_to_solve_5(formula)
+            except TimeoutError:
                 r1, t1 = r2+1, r2+1
 
             if r2 > r1 and t2 > t1 and res != 'unknown':
@@ -694,8 +1372,8 @@ class Agent:
         task1 = []
         task2 = []
         for instance, r, tac in eva_tuples:
-            runner1 = Z3Runner(instance, 20, tac.to_smt2(), idx)
-            runner2 = Z3Runner(instance, 20)
+            runner1 = Z3Runner(instance, 20, tac.to_smt2(), idx, self.solver.rlimit_budget)
+            runner2 = Z3Runner(instance, 20, budget=self.solver.rlimit_budget)
             idx = idx+1
 
             runner1.start()
@@ -845,10 +1523,32 @@ def main():
     parser.add_argument('--episode_cnt', type=int, default=5)
     parser.add_argument('--apply_cnt', type=int, default=10)
     parser.add_argument('--random_ep_cnt', type=int, default=1)
+    parser.add_argument('--result_cache', type=str, default=None, help='Database of solver results shared between runs')
+    parser.add_argument('--envs', type=int, default=1, help='Number of formulas explored in parallel during training')
+    parser.add_argument('--train_every', type=int, default=1, help='Number of applied tactics per gradient update')
+    parser.add_argument('--actors', type=int, default=0, help='Number of actor processes exploring for a separate learner')
+    parser.add_argument('--memory_size', type=int, default=2000, help='Capacity of the replay buffer')
+    parser.add_argument('--prioritized', type=bool, default=False, help='Sample transitions by their TD error')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Database of default z3 results per file, defaults to the result cache database')
+    parser.add_argument('--baseline_workers', type=int, default=1, help='Number of processes computing the baseline')
+    parser.add_argument('--use_rlimit', type=bool, default=False, help='Measure tactic cost in rlimit instead of time')
+    parser.add_argument('--rlimit_budget', type=int, default=0, help='Cap every solver call at this z3 rlimit instead of wall-clock time')
+    parser.add_argument('--ast_bow', type=bool, default=False, help='Count formula tokens on the z3 AST instead of the text')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Directory of the resumable training state')
+    parser.add_argument('--checkpoint_every', type=int, default=10, help='Number of episodes between checkpoints')
 
     args = parser.parse_args()
     os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
-    agent = Agent(json.load(open(args.configuration, 'r')), args.episode_cnt, args.apply_cnt, args.random_ep_cnt, args.exp_name, out_file=args.out_file)
+    result_cache = ResultCache(args.result_cache) if args.result_cache is not None else None
+    baseline_path = args.baseline if args.baseline is not None else args.result_cache
+    baseline = BaselineTable(baseline_path) if baseline_path is not None else None
+    agent = Agent(json.load(open(args.configuration, 'r')), args.episode_cnt, args.apply_cnt, args.random_ep_cnt, args.exp_name, out_file=args.out_file, result_cache=result_cache,
+                  num_envs=args.envs, train_every=args.train_every, num_actors=args.actors,
+                  memory_size=args.memory_size, prioritized=args.prioritized,
+                  checkpoint_dir=args.checkpoint, checkpoint_every=args.checkpoint_every,
+                  baseline=baseline, baseline_workers=args.baseline_workers, use_rlimit=args.use_rlimit,
+                  rlimit_budget=args.rlimit_budget, ast_bow=args.ast_bow)
     # agent.output_best_strategy()
 
     if args.mode == 'train':
@@ -879,12 +1579,16 @@ def main():
                     print("begin to evaluate", str(file))
                     try:
                         agent.solver.solve_by_z3(formula)
-                    except timeout_decorator.timeout_decorator.TimeoutError:
+                    except TimeoutError:
                         print("z3 timeout")
+                    except z3.Z3Exception as e:
+                        print("z3 failed:", e)
                     try:
                         agent.predict(formula, args.random_select)
-                    except timeout_decorator.timeout_decorator.TimeoutError:
+                    except TimeoutError:
                         print("predict timeout")
+                    except z3.Z3Exception as e:
+                        print("predict failed:", e)
 
     elif args.mode == 'tactic':
         with open(args.tactics, 'r') as f:
@@ -904,13 +1608,17 @@ def main():
                             print("begin to evaluate", str(file))
                             try:
                                 agent.solver.solve_by_z3(formula)
-                            except timeout_decorator.timeout_decorator.TimeoutError:
+                            except TimeoutError:
                                 print("z3 timeout")
+                            except z3.Z3Exception as e:
+                                print("z3 failed:", e)
 
                             try:
                                 agent.solver.solve_by_tactic(formula, tactic)
-                            except timeout_decorator.timeout_decorator.TimeoutError:
+                            except TimeoutError:
                                 print("predict timeout")
+                            except z3.Z3Exception as e:
+                                print("predict failed:", e)
 
             f.close()
     elif args.mode == 'combine_tactic':
@@ -926,13 +1634,17 @@ def main():
                         print("begin to evaluate", str(file))
                         try:
                             agent.solver.solve_by_z3(formula)
-                        except timeout_decorator.timeout_decorator.TimeoutError:
+                        except TimeoutError:
                             print("z3 timeout")
+                        except z3.Z3Exception as e:
+                            print("z3 failed:", e)
 
                         try:
                             agent.solver.solve_by_tactic(formula, tac)
-                        except timeout_decorator.timeout_decorator.TimeoutError:
+                        except TimeoutError:
                             print("predict timeout")
+                        except z3.Z3Exception as e:
+                            print("predict failed:", e)
         f.close()
     elif args.mode == 'collect_tactic':
         data_dict = {}
@@ -959,6 +1671,13 @@ def main():
         agent.online_net.eval()
         torch.onnx.export(agent.online_net, torch.randn(1, 117), 'tmp.pth')
 
+    if result_cache is not None:
+        print(result_cache.stats())
+        result_cache.close()
+    if baseline is not None:
+        baseline.close()
+    agent.solver.close()
+
 
 if __name__ == '__main__':
     main()
@@ -14,14 +14,22 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import argparse
+import hashlib
 import json
-import math
 import os
+from collections import OrderedDict
+from fractions import Fraction
 
+import numpy as np
 import z3
 
 from agent import SMTSolver, GoalTokenizer, StrategyEnumerator
 from language import objects
+from utils import parallel
+from utils.cache import GoalCache, ResultCache, SolveCache, goal_fingerprint, goal_hash, strategy_key
+from utils.capping import Capping
+from utils.goal_store import GoalStore, to_smt2
+from utils.probes import ProbeFeatures
 
 
 class Cond:
@@ -51,7 +59,11 @@ class ProbeCond:
         return '{} > {}'.format(str(self.ori), self.cond)
 
     def to_smt2(self):
-        return '> %s %s' % (self.ori.s, str(int(self.cond+0.5)))
+        if self.cond == int(self.cond):
+            return '> %s %d' % (self.ori.s, int(self.cond))
+        # thresholds of older trees may be fractional, SMT2 probes take them as exact rationals
+        cond = Fraction(str(self.cond))
+        return '> %s (/ %d %d)' % (self.ori.s, cond.numerator, cond.denominator)
 
 
 def find_prefix(tac_seqs):
@@ -89,16 +101,81 @@ def find_prefix(tac_seqs):
     return prefix, n_tac_list
 
 
-def split_data(formula_data, probe):
+class TacticTrie:
+    def __init__(self, tac=None):
+        self.tac = tac
+        self.children = {}
+        self.ends = []
+
+    @staticmethod
+    def build(tac_seqs):
+        root = TacticTrie()
+        for tac_i, tac_seq in tac_seqs:
+            node = root
+            for tac in tac_seq:
+                if str(tac) not in node.children:
+                    node.children[str(tac)] = TacticTrie(tac)
+                node = node.children[str(tac)]
+            node.ends.append(tac_i)
+        return root
+
+    def size(self):
+        return sum([1 + child.size() for child in self.children.values()])
+
+    def tac_ids(self):
+        res = list(self.ends)
+        for child in self.children.values():
+            res += child.tac_ids()
+        return res
+
+
+def join_split(pre_ts, minc, s_is, s_not):
+    back_ts = Cond(minc, s_is, s_not)
+    return objects.AndThen(*pre_ts, back_ts) if len(pre_ts) > 0 else back_ts
+
+
+def dump_tree(strategy):
+    pre_ts = []
+    if isinstance(strategy, objects.AndThen) and isinstance(strategy.v[-1], Cond):
+        pre_ts, strategy = strategy.v[:-1], strategy.v[-1]
+    if isinstance(strategy, Cond):
+        return {'pre': [str(tac) for tac in pre_ts], 'probe': strategy.p.ori.s, 'cond': strategy.p.cond,
+                'is': dump_tree(strategy.t1), 'not': dump_tree(strategy.t2)}
+    return {'leaf': str(strategy)}
+
+
+def load_tree(tree):
+    if 'leaf' in tree:
+        return objects.from_string(tree['leaf'])
+    return join_split([objects.from_string(tac) for tac in tree['pre']],
+                      ProbeCond(objects.Probe(tree['probe']), tree['cond']),
+                      load_tree(tree['is']), load_tree(tree['not']))
+
+
+def pack_datas(datas):
+    return [(name, to_smt2(formula)) for name, formula in datas]
+
+
+def unpack_datas(datas):
+    return [(name, z3.parse_smt2_file(name) if formula is None else z3.parse_smt2_string(formula))
+            for name, formula in datas]
+
+
+def pack_tacs(tac_seqs):
+    return [(i, [str(tac) for tac in tac_seq]) for i, tac_seq in tac_seqs]
+
+
+def unpack_tacs(tac_seqs):
+    return [(i, [objects.from_string(tac) for tac in tac_seq]) for i, tac_seq in tac_seqs]
+
+
+def split_mask(formula_data, mask):
     d_is, d_not = [], []
-    for name, data in formula_data:
-        g = z3.Goal()
-        g.add(data)
-        # print(str(probe), probe(g))
-        if probe(g) > 0.5:
-            d_is.append((name, data))
+    for d, m in zip(formula_data, mask):
+        if m:
+            d_is.append(d)
         else:
-            d_not.append((name, data))
+            d_not.append(d)
     return d_is, d_not
 
 
@@ -125,61 +202,177 @@ def choose_tac_with_prefix(tac_seqs, t_is):
 
 
 class Combiner:
-    def __init__(self, solver: SMTSolver, cache_path=None):
+    CACHE_KIND = 'seq'
+
+    def __init__(self, solver: SMTSolver, cache_path=None, workers=1, share_prefix=False, goal_budget=5000000,
+                 goal_cache=None, incremental=False, capping=None):
         self.TIMEOUT_COST = 50000000
         self.solver = solver
         self.min_data_len = 10
         self.solve_cache = None
-        self.probe_dict = {probe: set() for probe in z3.probes()}
         self.next_cache = {}
         self.r_cache = {}
         self.cache_path=cache_path
-
-    def gen_predicts(self):
-        predicts = []
-        for probe, values in self.probe_dict.items():
-            if len(values) <= 1:
+        timeout, budget = solver.limits()
+        self.cache = SolveCache(cache_path, timeout, budget=budget) if cache_path is not None else None
+        self.covered = {}
+        self.workers = workers
+        self.share_prefix = share_prefix
+        self.goal_budget = goal_budget
+        self.features = ProbeFeatures()
+        self.goal_cache = goal_cache
+        self.incremental = incremental
+        self.tac_keys = {}
+        # capped cells are left out of the solve cache, they are unsolved only relative to the budget
+        self.capping = capping if capping is not None else Capping()
+
+    def sweep_predicts(self, datas, solved, probes=None):
+        # for every probe, formulas are sorted by probe value once and all distinct thresholds
+        # are scored together with prefix sums of the solved matrix; the best threshold is kept
+        matrix = self.features.matrix([formula for _, formula in datas])
+        total = solved.sum(axis=0)
+        predicts, masks, split_costs = [], [], []
+        for probe in (probes if probes is not None else self.features.names):
+            col = self.features.column(matrix, probe)
+            order = np.argsort(col, kind='stable')
+            values = col[order]
+            # a threshold after position r puts the first r formulas on the 'not' side
+            bounds = np.nonzero(values[:-1] < values[1:])[0] + 1
+            # probes of SMT2 strategies are compared with integers, so only cuts an integer fits in are scored
+            cuts = np.ceil(values[bounds - 1])
+            bounds, cuts = bounds[cuts < values[bounds]], cuts[cuts < values[bounds]]
+            if len(bounds) == 0:
                 continue
-            p = objects.Probe(probe)
-            step = int(len(values)/16)
-            if step > 0:
-                for i in range(16):
-                    predicts.append(ProbeCond(p, int(list(values)[step*i])))
-                # predicts.append(ProbeCond(p, list(values)[step]))
-                # predicts.append(ProbeCond(p, list(values)[step*3]))
-            predicts.append(ProbeCond(p, (max(values)+min(values))/2.0))
-        print("=====gen predicts success")
-        return predicts
-
-    def append_probe_dict(self, datas):
-        for p in z3.probes():
-            if self.probe_dict.get(p) is None:
-                self.probe_dict[p] = set()
-            for _, formula in datas:
-                g = z3.Goal()
-                g.add(formula)
-                self.probe_dict[p].add(z3.Probe(p)(g))
-        return self.gen_predicts()
-
-    def remake_probe_dict(self, datas):
-        self.probe_dict = {}
-        return self.append_probe_dict(datas)
+            s_not = np.cumsum(solved[order], axis=0)[bounds - 1]
+            n_not = bounds.astype(np.float64)
+            cost = self.cost(len(datas) - n_not, n_not, total[None, :] - s_not, s_not)
+            k = int(np.argmin(cost))
+            cond = int(cuts[k])
+            predicts.append(ProbeCond(objects.Probe(probe), cond))
+            masks.append(col > cond)
+            split_costs.append(float(cost[k]))
+        masks = np.array(masks, dtype=bool).reshape((len(predicts), len(datas)))
+        return predicts, masks, split_costs
+
+    def cell_cost(self, res_seq, tac_seq):
+        return res_seq[-len(tac_seq)]
+
+    def solve_matrix(self, datas, tac_seqs):
+        solved = np.zeros((len(datas), len(tac_seqs)), dtype=np.float64)
+        costs = np.full((len(datas), len(tac_seqs)), float(self.TIMEOUT_COST))
+        for j, (i, tac_seq) in enumerate(tac_seqs):
+            cache = self.solve_cache[i]
+            for k, (name, _) in enumerate(datas):
+                if name in cache:
+                    solved[k, j] = 1
+                    if cache[name] is not None:
+                        costs[k, j] = self.cell_cost(cache[name], tac_seq)
+        return solved, costs
 
     def gen_strategy(self, datas, tacs, predicts=None):
         tacs = [(i, tac) for i, tac in enumerate(tacs)]
+        self.tac_keys = {i: strategy_key(tac) for i, tac in tacs}
         if self.solve_cache is None:
-            if self.cache_path is not None:
-                self.load_cache(self.cache_path)
+            self.load_cache(datas, tacs)
+            datas = self.init_solve_cache(datas, tacs)
+        # thresholds are searched on the data of every node, predicts only restrict the probes
+        probes = None
+        if predicts is not None:
+            probes = list(OrderedDict.fromkeys([c.ori.s for c in predicts]))
+        if self.workers > 1:
+            return self.parallel_gen_strategy(datas, tacs, probes)
+        return self.__gen_strategy(datas, tacs, probes)
+
+    def node_key(self, names, tac_seqs, probes):
+        # a node is determined by its files, the remaining part of its sequences and the searched probes,
+        # its subtree is reused by incremental runs as long as these are unchanged
+        if not self.incremental or self.cache is None:
+            return None
+        fhs = sorted([self.cache.file_hashes[name] for name in names])
+        seqs = sorted(['{}#{}'.format(self.tac_keys[i], len(tac_seq)) for i, tac_seq in tac_seqs])
+        return hashlib.sha1(json.dumps([fhs, seqs, probes, self.min_data_len]).encode('utf-8')).hexdigest()
+
+    def load_subtree(self, key, n_data):
+        if key is None:
+            return None
+        tree = self.cache.get_tree(self.CACHE_KIND, key)
+        if tree is not None:
+            print("==========reuse subtree of {} datas".format(n_data))
+        return tree
+
+    def save_subtree(self, key, strategy):
+        if key is not None:
+            self.cache.put_tree(self.CACHE_KIND, key, dump_tree(strategy))
+
+    def __gen_strategy(self, datas, tacs, probes):
+        key = self.node_key([name for name, _ in datas], tacs, probes)
+        tree = self.load_subtree(key, len(datas))
+        if tree is not None:
+            return load_tree(tree)
+
+        split, strategy = self.expand_node(datas, tacs, probes)
+        if split is None:
+            self.save_subtree(key, strategy)
+            return strategy
+        pre_ts, minc, (d_is, tacs_is), (d_not, tacs_not) = split
+        s_is = self.__gen_strategy(d_is, tacs_is, probes)
+        s_not = self.__gen_strategy(d_not, tacs_not, probes)
+        strategy = join_split(pre_ts, minc, s_is, s_not)
+        self.save_subtree(key, strategy)
+        return strategy
+
+    def parallel_gen_strategy(self, datas, tacs, probes):
+        # nodes are expanded on the pool as soon as their parent is split, and the tree is assembled
+        # by node id afterwards, so its shape does not depend on the order in which nodes finish
+        nodes = {}
+        keys = {}
+        reused = {}
+
+        def submit(node_id, d, tac_seqs):
+            keys[node_id] = self.node_key([name for name, _ in d], tac_seqs, probes)
+            tree = self.load_subtree(keys[node_id], len(d))
+            if tree is not None:
+                reused[node_id] = tree
+                return []
+            return [(node_id, d, tac_seqs, probes)]
+
+        def children(task, res):
+            node_id, _, _, _ = task
+            nodes[node_id] = res
+            split, _ = res
+            if split is None:
+                return []
+            _, _, _, d_is, tacs_is, d_not, tacs_not = split
+            return submit(node_id + '0', d_is, tacs_is) + submit(node_id + '1', d_not, tacs_not)
+
+        root = submit('', [(name, None) for name, _ in datas], pack_tacs(tacs))
+        result_cache = self.solver.cache.path if self.solver.cache is not None else None
+        if result_cache is not None:
+            self.solver.cache.flush()
+        if self.goal_cache is not None:
+            self.goal_cache.flush()
+        goal_cache = (self.goal_cache.path, self.goal_cache.max_bytes) if self.goal_cache is not None else None
+        initargs = (type(self), self.solve_cache, result_cache, goal_cache, self.solver.rlimit_budget)
+        for _ in parallel.expand_tasks(_expand_node_task, root, children, self.workers, _init_tree_worker, initargs):
+            pass
+
+        def build(node_id):
+            if node_id in reused:
+                return load_tree(reused[node_id])
+            split, strategy = nodes[node_id]
+            if split is None:
+                strategy = objects.from_string(strategy)
             else:
-                self.solve_cache = {}
-            datas = self.init_solve_cache(datas, tacs, (predicts is None))
-            if predicts is None:
-                predicts = self.append_probe_dict(datas)
-            if len(self.solve_cache) != len(datas):
-                self.load_cache(self.cache_path)
-        return self.__gen_strategy(datas, tacs, predicts)
-
-    def __gen_strategy(self, datas, tacs, predicts):
+                pre_ts, probe, cond, _, _, _, _ = split
+                strategy = join_split([objects.from_string(t) for t in pre_ts], ProbeCond(objects.Probe(probe), cond),
+                                      build(node_id + '0'), build(node_id + '1'))
+            self.save_subtree(keys[node_id], strategy)
+            return strategy
+
+        return build('')
+
+    def expand_node(self, datas, tacs, probes):
+        # returns (split, None) if the node is split by a Cond, (None, strategy) otherwise
         print("==========gen_strategy with {} datas".format(len(datas)))
         if len(datas) < self.min_data_len:
             best_tac = ((len(datas)+1, 0, -1), None)
@@ -190,7 +383,7 @@ class Combiner:
                 tac = objects.AndThen(*tac) if len(tac)>1 else tac[0]
                 unsolved, rlimit = self.solver.solve_dataset(n_data, tac.tactic)
                 best_tac = min(best_tac, ((unsolved, rlimit, tac_i), tac))
-            return best_tac[1]
+            return None, best_tac[1]
 
         pre_ts, tacs = find_prefix(tacs)
         print("pre_ts found")
@@ -201,9 +394,13 @@ class Combiner:
 
         t_is = t_not = None
         d_is = d_not = []
-        minc = predicts[0]
 
-        dlist = {c: split_data(datas, c) for c in predicts}
+        solved, costs = self.solve_matrix(datas, tacs)
+        predicts, masks, split_costs = self.sweep_predicts(datas, solved, probes)
+        if len(predicts) == 0:
+            return None, self.best_sequence(pre_ts, tacs, costs)
+        dlist = {c: split_mask(datas, masks[k]) for k, c in enumerate(predicts)}
+        minc = predicts[0]
 
         print("gen pre_ts as follow:")
         print(str(objects.AndThen('skip', 'skip', *pre_ts)))
@@ -216,22 +413,23 @@ class Combiner:
             if remake == len(predicts):
                 _, t_is, t_not = bst_tac
                 if t_is.s == 'skip':
-                    return objects.AndThen(*pre_ts) if len(pre_ts) > 1 else pre_ts[0]
+                    return None, objects.AndThen(*pre_ts) if len(pre_ts) > 1 else pre_ts[0]
                 elif str(t_is) != str(t_not):
                     break
                 datas = self.forward_data(datas, t_is)
-                tp = self.remake_probe_dict(datas)
-                if len(tp) > 0:
-                    predicts = self.remake_probe_dict(datas)
-                dlist = {c: split_data(datas, c) for c in predicts}
                 print("update pre_ts")
                 # print(str(objects.AndThen('skip', 'skip', *pre_ts)))
                 pre_ts.append(t_is)
                 tacs = shorten_tacs(tacs, t_is)
                 print(tacs)
+                solved, costs = self.solve_matrix(datas, tacs)
+                predicts, masks, split_costs = self.sweep_predicts(datas, solved, probes)
+                if len(predicts) == 0:
+                    return None, self.best_sequence(pre_ts, tacs, costs)
+                dlist = {c: split_mask(datas, masks[k]) for k, c in enumerate(predicts)}
                 remake = 0
                 bst_tac = (1e20, objects.Tactic('skip'), objects.Tactic('skip'))
-            clist = [self.cost(c, dlist[c][0], dlist[c][1], tacs) for c in predicts]
+            clist = list(split_costs)
             if remake < len(clist):
                 if remake > 0:
                     print("remake {}/{}".format(remake, len(clist)))
@@ -248,9 +446,9 @@ class Combiner:
             d_is, d_not = dlist[minc]
             print("try minc {} with cost {}".format(str(minc), clist[idx]))
             
-            sc_is, t_is = self.find_min_tac(d_is, tacs)
+            sc_is, t_is = self.find_min_tac(masks[idx], costs, tacs)
             print(sc_is, str(t_is))
-            sc_not, t_not = self.find_min_tac(d_not, tacs)
+            sc_not, t_not = self.find_min_tac(~masks[idx], costs, tacs)
             print(sc_not, str(t_not))
 
             r_is, r_not = len(d_is)/(len(datas)+1e-25), len(d_not)/(len(datas)+1e-25)
@@ -260,15 +458,20 @@ class Combiner:
             print("find tac branch {} and {}".format(t_is, t_not))
 
         if len(tacs) == 0:
-            return objects.AndThen(*pre_ts) if len(pre_ts) > 1 else pre_ts[0]
+            return None, objects.AndThen(*pre_ts) if len(pre_ts) > 1 else pre_ts[0]
 
         print("go to other branch {} and {}".format(str(t_is), str(t_not)))
-        p_is = self.remake_probe_dict(d_is)
-        p_not = self.remake_probe_dict(d_not)
-        s_is = self.__gen_strategy(d_is, choose_tac_with_prefix(tacs, t_is), p_is)
-        s_not = self.__gen_strategy(d_not, choose_tac_with_prefix(tacs, t_not), p_not)
-        back_ts = Cond(minc, s_is, s_not)
-        return objects.AndThen(*pre_ts, back_ts) if len(pre_ts) > 0 else back_ts
+        return (pre_ts, minc, (d_is, choose_tac_with_prefix(tacs, t_is)), (d_not, choose_tac_with_prefix(tacs, t_not))), None
+
+    def best_sequence(self, pre_ts, tacs, costs):
+        # no probe separates the formulas, all of them get the sequence with least average cost
+        ts = list(pre_ts)
+        if len(tacs) > 0:
+            idx = int(np.argmin(costs.mean(axis=0))) if costs.shape[0] > 0 else 0
+            ts += list(tacs[idx][1])
+        if len(ts) == 0:
+            return objects.Tactic('skip')
+        return objects.AndThen(*ts) if len(ts) > 1 else ts[0]
 
     def forward_data(self, old_data, tac_seq):
         if not isinstance(tac_seq, list):
@@ -278,6 +481,7 @@ class Combiner:
         n_data = []
         cnt = 0
         stp = int(len(old_data) / 20) + 1
+        strategy = strategy_key(tac_seq)
         for name, data in old_data:
             if cnt % stp == 0:
                 print("forward {}th data".format(cnt))
@@ -291,112 +495,92 @@ class Combiner:
             #     formula = self.next_cache[str(data)][str(tac_seq[0])]
             #     tac_seq = tac_seq[1:]
             if len(tac_seq) > 0:
-                _, _, n_formula, _ = self.solver.solve_with_tactic_seq(formula, tac_seq)
+                n_formula = None
+                if self.goal_cache is not None:
+                    key = goal_hash(formula)
+                    smt2 = self.goal_cache.get(key, strategy)
+                    if smt2 is not None:
+                        n_formula = z3.parse_smt2_string(smt2)
+                if n_formula is None:
+                    _, _, n_formula, _ = self.solver.solve_with_tactic_seq(formula, tac_seq)
+                    if self.goal_cache is not None:
+                        self.goal_cache.put(key, strategy, to_smt2(n_formula))
             else:
                 n_data.append((name, formula))
                 n_formula = formula
                 continue
-            if formula is not None and str(formula) != str(n_formula):
+            if formula is not None and goal_fingerprint(formula) != goal_fingerprint(n_formula):
                 n_data.append((name, n_formula))
         return n_data
 
-    def cost(self, predict, d_is, d_not, tac_seqs):
-        if len(d_is) == 0 or len(d_not) == 0:
-            return float('inf')
-        tot_len = len(d_is) + len(d_not)
-
-        def hts(ds):
-            tot = 0.0
-            dname = [name for name, formula in ds]
-            for i, tac_seq in tac_seqs:
-                solved = len(set(dname) & set(self.solve_cache[i].keys()))
-                ratio = solved / len(ds)
-                if ratio > 0.5:
-                    ratio -= 0.001
-                else:
-                    ratio += 0.001
-                tot += ratio * math.log(ratio) + (1-ratio) * math.log(1-ratio)
-            return -tot
-
-        return len(d_is)/tot_len*hts(d_is) + len(d_not)/tot_len*hts(d_not)
-
-    def find_min_tac(self, d_is, tac_seqs):
+    def cost(self, n_is, n_not, s_is, s_not):
+        # entropy of solved ratios on both sides of a batch of splits, n_* are sizes of the sides
+        # and s_* the (splits x tac_seqs) numbers of solved formulas on the sides
+        def hts(s, n):
+            ratio = s / np.maximum(n, 1)[:, None]
+            ratio = np.where(ratio > 0.5, ratio - 0.001, ratio + 0.001)
+            return -(ratio * np.log(ratio) + (1-ratio) * np.log(1-ratio)).sum(axis=1)
+
+        tot_len = np.maximum(n_is + n_not, 1)
+        res = n_is/tot_len*hts(s_is, n_is) + n_not/tot_len*hts(s_not, n_not)
+        res[(n_is == 0) | (n_not == 0)] = float('inf')
+        return res
+
+    def find_min_tac(self, mask, costs, tac_seqs):
         res = (1e20, objects.Tactic('skip'))
         if len(tac_seqs) == 0:
             return res
-        if len(d_is) == 0:
+        n = int(mask.sum())
+        if n == 0:
             tac_seq = tac_seqs[0][1]
             if len(tac_seq) > 0:
                 return (1e19, tac_seqs[0][1][0])
             else:
                 return res
-        record = {}
-        for i, tac_seq in tac_seqs:
-            tot = 0
-            # print(len(d_is))
-            for name, data in d_is:
-                # print(i, name, len(tac_seq))
-                if self.solve_cache[i].get(name) is None:
-                    tot += self.TIMEOUT_COST
-                else:
-                    # print(len(tac_seq), tac_seq)
-                    # print(self.solve_cache[i][name])
-                    tot += self.solve_cache[i][name][-len(tac_seq)]
-            # print(tot, str(tac_seq[0]))
-            tot /= len(d_is)
-            if res[0] > tot:
-                res = (tot, tac_seq[0])
-            # if record.get(str(tac_seq[0])) is None:
-            #     record[str(tac_seq[0])] = tot
-            # elif record[str(tac_seq[0])] > tot:
-            #     record[str(tac_seq[0])] = tot
-        # print("min tac printing================")
-        # for a, b in record.items():
-        #     print(a, b)
-        # print("================================")
+        tot = costs[mask].sum(axis=0) / n
+        idx = int(np.argmin(tot))
+        if res[0] > tot[idx]:
+            res = (float(tot[idx]), tac_seqs[idx][1][0])
         return res
 
-    def save_cache(self, outfile, content):
-        if outfile is None or content is None:
-            return
-        with open(outfile, 'a') as f:
-            f.write('\n')
-            f.write(str(content))
-            f.close()
-        # with open("_"+outfile, 'w') as f:
-        #     f.write(str(self.probe_dict))
-
-    def load_cache(self, outfile):
-        if outfile is None:
-            return
-        if not os.path.exists(outfile):
+    def save_cache(self, tac_seq, content):
+        if self.cache is None or content is None:
             return
+        strategy = strategy_key(tac_seq)
+        for data, value in content.items():
+            self.cache.put(self.CACHE_KIND, strategy, data, value)
+        self.cache.flush()
+
+    def load_cache(self, datas, tac_seqs):
         if self.solve_cache is None:
             self.solve_cache = {}
+        if self.cache is None:
+            return
 
-        now_i = 0
-        with open(outfile, 'r+')  as f:
-            lines = f.readlines()
-            for line in lines:
-                if now_i % 10 == 0:
-                    print("load {}th data".format(now_i))
-                if len(line) > 1:
-                    self.solve_cache[now_i] = eval(line)
-                else:
-                    print("skip")
+        hashes = self.cache.hash_files(datas)
+        records = self.cache.load(self.CACHE_KIND)
+        tot = 0
+        for tac_i, tac_seq in tac_seqs:
+            strategy = strategy_key(tac_seq)
+            solved = {}
+            covered = set()
+            for data in datas:
+                value = records.get((strategy, hashes[data]))
+                if value is None and (strategy, hashes[data]) not in records:
                     continue
-                # print(self.solve_cache[now_i].keys())
-                now_i += 1
-        print("load total {} datas".format(now_i))
-
-        # with open("_"+outfile, 'r+') as f:
-        #     self.probe_dict = eval(f.readline())
-
-        print("load success")
-        # with open(outfile, 'a+') as f:
-        #     f.truncate(0)
-
-    def init_solve_cache(self, datas, tac_seqs, collect_probes=False):
+                covered.add(data)
+                if value is not None:
+                    solved[data] = value
+            self.solve_cache[tac_i] = solved
+            self.covered[tac_i] = covered
+            tot += len(covered)
+        print("load total {} cached results".format(tot))
+        new_datas = [data for data in datas if all([data not in covered for covered in self.covered.values()])]
+        new_tacs = [tac_i for tac_i, _ in tac_seqs if len(self.covered[tac_i]) == 0]
+        print("{} new formulas, {} new tac_seqs, {} of {} cells to evaluate".format(
+            len(new_datas), len(new_tacs), len(datas) * len(tac_seqs) - tot, len(datas) * len(tac_seqs)))
+
+    def init_solve_cache(self, datas, tac_seqs):
         print('=========start to init solve cache:')
         n_data = []
         if self.solve_cache is None:
@@ -405,80 +589,232 @@ class Combiner:
         for data_i, data in enumerate(datas):
             n_data.append((data, z3.parse_smt2_file(data)))
 
+        if self.share_prefix:
+            self.trie_solve_cache(n_data, tac_seqs)
+            print('=========solve cache init finished')
+            return n_data
+
+        if self.workers > 1:
+            self.parallel_solve_cache(n_data, tac_seqs)
+            print('=========solve cache init finished')
+            return n_data
+
+        self.serial_solve_cache(n_data, tac_seqs)
+        print('=========solve cache init finished')
+        return n_data
+
+    def serial_solve_cache(self, n_data, tac_seqs):
+        tac_dict = dict(tac_seqs)
         for tac_i, tac_seq in tac_seqs:
             if self.solve_cache.get(tac_i) is None:
                 self.solve_cache[tac_i] = {}
-            else:
-                # assert len(tac_seq)+1 == len(list(self.solve_cache[tac_i].values())[0]), "{} {}:{}".format(tac_i, str([str(t) for t in tac_seq]), list(self.solve_cache[tac_i].values())[0])
+            covered = self.covered.get(tac_i, set())
+            if len(covered) == len(n_data):
                 print("skip {}th tac_seq".format(tac_i))
                 continue
             print("===evaluate {}th tac_seq".format(tac_i))
 
-            tmp_cache = {}
-            for data_i, data in enumerate(datas):
+            for data_i, (data, formula) in enumerate(n_data):
                 if data_i % 50 == 0:
                     print("evaluate {}th formula".format(data_i))
-                # print(self.solve_cache[tac_i].keys())
-                # print(self.solve_cache[tac_i][data])
-                # if self.solve_cache[tac_i].get(data) is not None:
-                    # print("use cache")
-                    # continue
-                formula = z3.parse_smt2_file(data)
-                
-                rtime = 0
-                res_seq = [0.0]
-
-                def append_seq():
-                    if collect_probes:
-                        g = z3.Goal()
-                        g.add(formula)
-                        for p in z3.probes():
-                            if self.probe_dict.get(p) is None:
-                                self.probe_dict[p] = set()
-                            self.probe_dict[p].add(z3.Probe(p)(g))
-                    res_seq.append(rtime)
-
-                    #     if self.next_cache[str(formula)].get(str(tac)) is not None:
-                    #         rtime, n_formula = self.r_cache[str(formula)][str(tac)], self.next_cache[str(formula)][str(tac)]
-                    #         formula = n_formula
-                    #         append_seq()
-                    #         continue
-                for tac in tac_seq:
-                    try:
-                        res, rtime, n_formula = self.solver.solve_goal(formula, tac.tactic, use_rlimit=True)
-                    except z3.z3types.Z3Exception:
-                        res, rtime, n_formula = 'unknown', 50000000, None
-
-                    if n_formula is None:
-                        break
-
-                    # if self.r_cache.get(str(formula)) is None:
-                    #     self.next_cache[str(formula)] = {}
-                    #     self.r_cache[str(formula)] = {}
-                    # self.r_cache[str(formula)][str(tac)] = rtime
-                    # self.next_cache[str(formula)][str(tac)] = n_formula
-                    formula = n_formula
-
-                    append_seq()
+                if data in covered:
+                    continue
+                budget = self.capping.budget(data)
+                self.record_cell((tac_i, data, budget), self.eval_formula(data, tac_seq, budget, formula), tac_dict)
+            if self.cache is not None:
+                self.cache.flush()
+
+    def eval_formula(self, data, tac_seq, cap=None, formula=None):
+        """ Evaluates one (tac_seq, formula) cell, the serial loop and the workers both go through here.
+
+        :param data: path of the formula
+        :param tac_seq: list of tactics applied one after another
+        :param cap: rlimit budget of the whole sequence, None if unlimited
+        :param formula: parsed formula of data, read from the file if None
+        :return: (suffix sums of the step costs or None if unsolved, whether the run reached cap)
+        """
+        if formula is None:
+            formula = z3.parse_smt2_file(data)
+        rtime = 0
+        res = 'unknown'
+        res_seq = [0.0]
+        used = 0
+
+        for tac in tac_seq:
+            if cap is not None and used >= cap:
+                break
+            try:
+                res, rtime, n_formula = self.solver.solve_goal(formula, tac.tactic, use_rlimit=True,
+                                                               cap=cap - used if cap is not None else None)
+            except z3.z3types.Z3Exception:
+                res, rtime, n_formula = 'unknown', 50000000, None
 
-                if res != 'unknown':
-                    for i in range(len(res_seq)):
-                        if i > 0:
-                            res_seq[len(res_seq)-i-1] += res_seq[len(res_seq)-i]
-                    tmp_cache[data] = res_seq
-                    #print(res_seq)
-            self.save_cache(self.cache_path, tmp_cache)
+            if n_formula is None:
+                break
+            used += rtime
+
+            formula = n_formula
+            res_seq.append(rtime)
+
+        if cap is not None and used >= cap:
+            return None, True
+        if res != 'unknown':
+            for i in range(len(res_seq)):
+                if i > 0:
+                    res_seq[len(res_seq)-i-1] += res_seq[len(res_seq)-i]
+            return res_seq, False
+        return None, False
+
+    def eval_trie(self, data, trie):
+        # every intermediate goal is computed once and shared by all sequences below it
+        res_seqs = {tac_i: None for tac_i in trie.tac_ids()}
+        store = GoalStore(self.goal_budget)
+
+        def visit(node, handle, path):
+            for child in node.children.values():
+                try:
+                    res, rtime, n_formula = self.solver.solve_goal(store.get(handle), child.tac.tactic, use_rlimit=True)
+                except z3.z3types.Z3Exception:
+                    res, rtime, n_formula = 'unknown', 50000000, None
 
-        print('=========solve cache init finished')
-        return n_data
+                if n_formula is None:
+                    continue
+
+                n_path = path + [rtime]
+
+                if res != 'unknown':
+                    for tac_i in child.ends:
+                        res_seq = [0.0] + n_path
+                        for i in range(len(res_seq)):
+                            if i > 0:
+                                res_seq[len(res_seq)-i-1] += res_seq[len(res_seq)-i]
+                        res_seqs[tac_i] = res_seq
+
+                if len(child.children) > 0:
+                    n_handle = store.put(n_formula)
+                    n_formula = None
+                    visit(child, n_handle, n_path)
+                    store.release(n_handle)
+
+        visit(trie, store.put(z3.parse_smt2_file(data)), [])
+        if store.spill_cnt > 0:
+            print("spill {} goals of {}".format(store.spill_cnt, data))
+        store.close()
+        return res_seqs
+
+    def trie_solve_cache(self, n_data, tac_seqs):
+        tac_dict = dict(tac_seqs)
+        tasks = []
+        shared_cnt, tot_cnt = 0, 0
+        for tac_i, _ in tac_seqs:
+            if self.solve_cache.get(tac_i) is None:
+                self.solve_cache[tac_i] = {}
+        for data, _ in n_data:
+            tac_ids = tuple([tac_i for tac_i, _ in tac_seqs if data not in self.covered.get(tac_i, set())])
+            if len(tac_ids) > 0:
+                tasks.append((data, tac_ids))
+                shared_cnt += TacticTrie.build([(tac_i, tac_dict[tac_i]) for tac_i in tac_ids]).size()
+                tot_cnt += sum([len(tac_dict[tac_i]) for tac_i in tac_ids])
+        print("===evaluate {} formulas with {} tactic applications instead of {}".format(len(tasks), shared_cnt, tot_cnt))
+
+        def serial_results():
+            for task in tasks:
+                data, tac_ids = task
+                trie = TacticTrie.build([(tac_i, tac_dict[tac_i]) for tac_i in tac_ids])
+                yield task, self.eval_trie(data, trie)
+
+        if self.workers > 1:
+            result_cache = self.solver.cache.path if self.solver.cache is not None else None
+            if result_cache is not None:
+                self.solver.cache.flush()
+            initargs = (type(self), [(tac_i, [str(tac) for tac in tac_seq]) for tac_i, tac_seq in tac_seqs],
+                        result_cache, self.goal_budget, self.solver.rlimit_budget)
+            results = parallel.imap_tasks(_eval_trie_task, tasks, self.workers, _init_eval_worker, initargs)
+        else:
+            results = serial_results()
+
+        for task_i, (task, res) in enumerate(results):
+            if task_i % 50 == 0:
+                print("evaluate {}th formula".format(task_i))
+            data, _ = task
+            for tac_i, res_seq in res.items():
+                if res_seq is not None:
+                    self.solve_cache[tac_i][data] = res_seq
+                if self.cache is not None:
+                    self.cache.put(self.CACHE_KIND, strategy_key(tac_dict[tac_i]), data, res_seq)
+        if self.cache is not None:
+            self.cache.flush()
+
+    def parallel_solve_cache(self, n_data, tac_seqs):
+        tasks = []
+        pending = {}
+        for tac_i, tac_seq in tac_seqs:
+            if self.solve_cache.get(tac_i) is None:
+                self.solve_cache[tac_i] = {}
+            covered = self.covered.get(tac_i, set())
+            for data, _ in n_data:
+                if data in covered:
+                    continue
+                # with capping a formula without known best cost is solved by one sequence at a time,
+                # the others are scheduled with a budget once it is solved
+                if self.capping.enabled and self.capping.budget(data) is None and data in pending:
+                    pending[data].append(tac_i)
+                    continue
+                pending.setdefault(data, [])
+                tasks.append((tac_i, data, self.capping.budget(data)))
+        print("===evaluate {} (tac_seq, formula) pairs with {} workers".format(
+            len(tasks) + sum(map(len, pending.values())), self.workers))
+
+        def expand(task, res):
+            tac_i, data, budget = task
+            if budget is not None or len(pending.get(data, [])) == 0:
+                return []
+            res_seq, _ = res
+            if res_seq is None:
+                # the next sequence takes over until one of them solves the formula
+                return [(pending[data].pop(0), data, None)]
+            self.capping.observe(data, 'sat', self.cell_cost(res_seq, tac_dict[tac_i]))
+            n_tasks = [(n_tac_i, data, self.capping.budget(data)) for n_tac_i in pending[data]]
+            pending[data] = []
+            return n_tasks
+
+        tac_dict = dict(tac_seqs)
+        result_cache = self.solver.cache.path if self.solver.cache is not None else None
+        if result_cache is not None:
+            self.solver.cache.flush()
+        initargs = (type(self), [(tac_i, [str(tac) for tac in tac_seq]) for tac_i, tac_seq in tac_seqs],
+                    result_cache, None, self.solver.rlimit_budget)
+        for task_i, (task, res) in enumerate(parallel.expand_tasks(_eval_cache_task, tasks, expand, self.workers,
+                                                                   _init_eval_worker, initargs)):
+            if task_i % 50 == 0:
+                print("evaluate {}th (tac_seq, formula) pair".format(task_i))
+            self.record_cell(task, res, tac_dict)
+        if self.cache is not None:
+            self.cache.flush()
+
+    def record_cell(self, task, res, tac_dict):
+        """ Stores the result of eval_formula for a (tac_seq, formula, budget) task. """
+        tac_i, data, _ = task
+        res_seq, capped = res
+        if capped:
+            # capped cells are unsolved only relative to the budget and are not stored
+            self.capping.capped_cnt += 1
+            return
+        if res_seq is not None:
+            self.solve_cache[tac_i][data] = res_seq
+            self.capping.observe(data, 'sat', self.cell_cost(res_seq, tac_dict[tac_i]))
+        if self.cache is not None:
+            self.cache.put(self.CACHE_KIND, strategy_key(tac_dict[tac_i]), data, res_seq)
 
 
 class QuickCombiner(Combiner):
-    def __init__(self, solver, cache_path=None):
-        super().__init__(solver, cache_path)
+    CACHE_KIND = 'quick'
+
+    def __init__(self, solver, cache_path=None, workers=1, goal_cache=None, incremental=False, capping=None):
+        super().__init__(solver, cache_path, workers, goal_cache=goal_cache, incremental=incremental, capping=capping)
         self.TIMEOUT_COST = 5e10
 
-    def init_solve_cache(self, datas, tac_seqs, collect_probes=False):
+    def init_solve_cache(self, datas, tac_seqs):
         print('=========start to init quick solve cache:')
         n_data = []
         if self.solve_cache is None:
@@ -487,59 +823,86 @@ class QuickCombiner(Combiner):
         for data_i, data in enumerate(datas):
             n_data.append((data, z3.parse_smt2_file(data)))
 
-        for tac_i, tac_seq in tac_seqs:
-            if self.solve_cache.get(tac_i) is None:
-                self.solve_cache[tac_i] = {}
-            else:
-                continue
+        if self.workers > 1:
+            self.parallel_solve_cache(n_data, tac_seqs)
+            print('=========solve cache init finished')
+            return n_data
 
-            print("===evaluate {}th tac_seq".format(tac_i))
+        self.serial_solve_cache(n_data, tac_seqs)
+        print('=========solve cache init finished')
+        return n_data
 
-            tmp_cache = {}
-            for data_i, formulas in enumerate(n_data):
-                if data_i % 50 == 0:
-                    print("evaluate {}th formula".format(data_i))
+    def eval_formula(self, data, tac_seq, cap=None, formula=None):
+        if formula is None:
+            formula = z3.parse_smt2_file(data)
+        tac = objects.AndThen(*tac_seq) if len(tac_seq) > 1 else tac_seq[0]
 
-                data, formula = formulas
-                tac = objects.AndThen(*tac_seq) if len(tac_seq) > 1 else tac_seq[0]
+        try:
+            res, rtime, _, _ = self.solver.solve_cached(formula, tac, cap=cap)
+        except z3.z3types.Z3Exception:
+            res, rtime = 'unknown', 5e7
 
-                try:
-                    res, rtime, _ = self.solver.solve_goal(formula, tac.tactic, use_rlimit=True)
-                except z3.z3types.Z3Exception:
-                    res, rtime = 'unknown', 5e7
+        if cap is not None and rtime >= cap:
+            return None, True
+        if str(res) != 'unknown':
+            return rtime, False
+        return None, False
 
-                if str(res) != 'unknown':
-                    tmp_cache[data] = rtime
-                    
-            self.save_cache(self.cache_path, tmp_cache)
+    def cell_cost(self, res_seq, tac_seq):
+        return res_seq
 
-        print('=========solve cache init finished')
-        return n_data
 
-    def find_min_tac(self, d_is, tac_seqs):
-        res = (1e20, objects.Tactic('skip'))
-        if len(tac_seqs) == 0:
-            return res
-        if len(d_is) == 0:
-            tac_seq = tac_seqs[0][1]
-            if len(tac_seq) > 0:
-                return (1e19, tac_seqs[0][1][0])
-            else:
-                return res
-        record = {}
-        for i, tac_seq in tac_seqs:
-            tot = 0
-            for name, data in d_is:
-                if self.solve_cache[i].get(name) is None:
-                    tot += self.TIMEOUT_COST
-                else:
-                    tot += self.solve_cache[i][name]
-            tot /= len(d_is)
-            if res[0] > tot:
-                res = (tot, tac_seq[0])
-        return res
+_eval_combiner = None
+_eval_tac_seqs = None
 
 
+def _init_eval_worker(combiner_cls, tac_seqs, result_cache=None, goal_budget=None, rlimit_budget=0):
+    global _eval_combiner, _eval_tac_seqs
+    cache = ResultCache(result_cache) if result_cache is not None else None
+    if cache is not None:
+        # results are committed in batches, the last one once the pool is done
+        parallel.at_exit(cache.close)
+    _eval_combiner = combiner_cls(SMTSolver(GoalTokenizer(), None, cache, rlimit_budget=rlimit_budget))
+    if goal_budget is not None:
+        _eval_combiner.goal_budget = goal_budget
+    _eval_tac_seqs = {tac_i: [objects.from_string(tac) for tac in tac_seq] for tac_i, tac_seq in tac_seqs}
+
+
+def _eval_cache_task(task):
+    tac_i, data, budget = task
+    return _eval_combiner.eval_formula(data, _eval_tac_seqs[tac_i], budget)
+
+
+def _eval_trie_task(task):
+    data, tac_ids = task
+    trie = TacticTrie.build([(tac_i, _eval_tac_seqs[tac_i]) for tac_i in tac_ids])
+    return _eval_combiner.eval_trie(data, trie)
+
+
+_tree_combiner = None
+
+
+def _init_tree_worker(combiner_cls, solve_cache, result_cache=None, goal_cache=None, rlimit_budget=0):
+    global _tree_combiner
+    cache = ResultCache(result_cache) if result_cache is not None else None
+    if cache is not None:
+        parallel.at_exit(cache.close)
+    _tree_combiner = combiner_cls(SMTSolver(GoalTokenizer(), None, cache, rlimit_budget=rlimit_budget))
+    if goal_cache is not None:
+        _tree_combiner.goal_cache = GoalCache(goal_cache[0], goal_cache[1])
+        parallel.at_exit(_tree_combiner.goal_cache.close)
+    _tree_combiner.solve_cache = solve_cache
+
+
+def _expand_node_task(task):
+    _, datas, tac_seqs, probes = task
+    split, strategy = _tree_combiner.expand_node(unpack_datas(datas), unpack_tacs(tac_seqs), probes)
+    if split is None:
+        return None, str(strategy)
+    pre_ts, minc, (d_is, tacs_is), (d_not, tacs_not) = split
+    return ([str(tac) for tac in pre_ts], minc.ori.s, minc.cond,
+            pack_datas(d_is), pack_tacs(tacs_is), pack_datas(d_not), pack_tacs(tacs_not)), None
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -549,8 +912,21 @@ def main():
     parser.add_argument('--cache_path', type=str, default='solve_cache.cache')
     parser.add_argument('--old_type', type=bool, default=False)
     parser.add_argument('--valid_data', type=str, default='None')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to build the solve cache')
+    parser.add_argument('--compact_cache', type=bool, default=False, help='Compact the solve cache and exit')
+    parser.add_argument('--result_cache', type=str, default=None, help='Database of solver results shared between runs')
+    parser.add_argument('--share_prefix', type=bool, default=False, help='Evaluate tactic sequences as a prefix trie (old_type only)')
+    parser.add_argument('--goal_budget', type=int, default=5000000, help='Expressions of intermediate goals kept in memory')
+    parser.add_argument('--goal_cache', type=str, default=None, help='Database of forwarded goals shared between runs')
+    parser.add_argument('--goal_cache_bytes', type=int, default=1 << 30, help='Maximum size of the goal cache in bytes')
+    parser.add_argument('--incremental', type=bool, default=False, help='Reuse subtrees whose data and sequences are unchanged')
+    parser.add_argument('--rlimit_budget', type=int, default=0, help='Cap every solver call at this z3 rlimit instead of wall-clock time')
     args = parser.parse_args()
 
+    if args.compact_cache:
+        SolveCache(args.cache_path).compact()
+        return
+
     data = []
     for root, directories, filenames in os.walk(args.train_data):
         for file in filenames:
@@ -581,14 +957,28 @@ def main():
         f.close()
 
     tokenizer = GoalTokenizer()
-    enumrator = StrategyEnumerator(**json.load(open(args.configuration, 'r'))['tactics_config'])
+    config = json.load(open(args.configuration, 'r'))
+    enumrator = StrategyEnumerator(**config['tactics_config'])
+    capping = Capping.from_config(config)
+    result_cache = ResultCache(args.result_cache) if args.result_cache is not None else None
+    goal_cache = GoalCache(args.goal_cache, args.goal_cache_bytes) if args.goal_cache is not None else None
     
     if args.old_type:
-        cb = Combiner(SMTSolver(tokenizer, enumrator), args.cache_path)
+        cb = Combiner(SMTSolver(tokenizer, enumrator, result_cache, rlimit_budget=args.rlimit_budget), args.cache_path, args.workers,
+                      args.share_prefix, args.goal_budget, goal_cache, args.incremental, capping)
     else:
-        cb = QuickCombiner(SMTSolver(tokenizer, enumrator), args.cache_path)
+        cb = QuickCombiner(SMTSolver(tokenizer, enumrator, result_cache, rlimit_budget=args.rlimit_budget), args.cache_path, args.workers, goal_cache,
+                           args.incremental, capping)
 
     result = cb.gen_strategy(data, tac_seqs)
+    if capping.enabled:
+        print("{} evaluations capped".format(capping.capped_cnt))
+    if result_cache is not None:
+        print(result_cache.stats())
+        result_cache.close()
+    if goal_cache is not None:
+        print(goal_cache.stats())
+        goal_cache.close()
     print(str(result))
     print(str(result.to_smt2()))
 
@@ -2,4 +2,5 @@
 python3 -u agent.py \
 	--train_data experiments/data/core/train/ \
 	--configuration experiments/configs/normal_config.json\
+	--result_cache cache/results.db \
 	--out_file core_sample_gen.tacs
@@ -1,4 +1,5 @@
 python3 tuner.py \
 	--tactics core_sample_gen.tac \
 	--quick_tuner True \
+	--result_cache cache/results.db \
 	| tee core_sample_tuner.tac
@@ -3,6 +3,7 @@ python3 -u combiner.py \
 	--train_data experiments/data/core/train/ \
 	--valid_data experiments/data/core/valid/ \
 	--cache_path cache/core_sample.cac \
+	--result_cache cache/results.db \
 	| tee core_sample_combine.log
 
 tail -1 core_sample_combine.log | tee core_sample.tac
@@ -15,46 +15,90 @@ limitations under the License.
 """
 
 import argparse
+import multiprocessing
 import shlex
 import numpy as np
 import os
+import queue
+import signal
 import subprocess
+import sys
 import tempfile
 import threading
 import time
 import z3
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.baseline import BaselineTable
+from utils.cache import ResultCache, file_hash
+
 PER = [0.1, 0.5, 0.9]
-RND = np.random.randint(10**9)
+
+
+def parse_output(out):
+    """ Returns result and rlimit from output of z3 with statistics, result is None if unknown. """
+    lines = out.split('\n')
+    res = lines[0]
+
+    rlimit = None
+    for line in lines:
+        if 'rlimit' in line:
+            tokens = line.split(' ')
+            for token in tokens:
+                token = token.rstrip(')')
+                if token.isdigit():
+                    rlimit = int(token)
+
+    if res == 'unknown':
+        res = None
+    return res, rlimit
 
 class Z3Runner(threading.Thread):
     """ Runner which executes a single tactic on a single goal. """
 
-    def __init__(self, smt_file, timeout, strategy=None, id=1):
+    def __init__(self, smt_file, timeout, strategy=None, id=1, grace=1, budget=0):
         threading.Thread.__init__(self)
         self.smt_file = smt_file
         self.timeout = timeout
+        self.grace = grace
+        self.budget = budget
         self.strategy = strategy
+        self.timed_out = False
+        self.out = None
+        self.on_done = None
+        self.new_file_name = self.smt_file
 
+        # the rewritten script is piped to z3, so nothing is written to disk
+        self.script = None
         if self.strategy is not None:
-            self.tmp_file = open('tmp/tmp_valid_{}_{}.smt2'.format(RND, id), 'w')
             with open(self.smt_file, 'r') as f:
-                for line in f:
-                    new_line = line
-                    if 'check-sat' in line:
-                        new_line = '(check-sat-using %s)\n' % strategy
-                    self.tmp_file.write(new_line)
-            self.tmp_file.close()
-            self.new_file_name = 'tmp/tmp_valid_{}_{}.smt2'.format(RND, id)
-        else:
-            self.new_file_name = self.smt_file
+                self.script = ''.join([('(check-sat-using %s)\n' % strategy) if 'check-sat' in line else line
+                                       for line in f]).encode('utf-8')
 
     def run(self):
+        # the deadline starts with this process, not with the other runners
         self.time_before = time.time()
-        z3_cmd = 'z3 -smt2 %s -st' % self.new_file_name
-        self.p = subprocess.Popen(shlex.split(z3_cmd), stdout=subprocess.PIPE)
-        self.p.wait()
+        if self.script is not None:
+            z3_cmd = 'z3 -smt2 -in -st'
+        else:
+            z3_cmd = 'z3 -smt2 %s -st' % self.smt_file
+        if self.budget > 0:
+            z3_cmd += ' rlimit=%d' % self.budget
+        self.p = subprocess.Popen(shlex.split(z3_cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self.out, _ = self.p.communicate(self.script, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.timed_out = True
+            self.p.terminate()
+            try:
+                self.p.communicate(timeout=self.grace)
+            except subprocess.TimeoutExpired:
+                self.p.kill()
+                self.p.wait()
+                self.p.stdout.close()
         self.time_after = time.time()
+        if self.on_done is not None:
+            self.on_done(self)
 
     def collect(self):
         if self.is_alive():
@@ -65,23 +109,218 @@ class Z3Runner(threading.Thread):
                 pass
             return None, None, None
 
-        out, err = self.p.communicate()
+        if self.timed_out:
+            return None, None, None
+
+        res, rlimit = parse_output(self.out[:-1].decode("utf-8"))
+        return res, rlimit, self.time_after - self.time_before
+
+
+def api_solve(smt_file, strategy, timeout, budget=0):
+    """ Solves a benchmark through the z3 API the same way Z3Runner does through the z3 binary. With a
+    positive rlimit budget z3 stops on the budget, the caller still kills it after timeout. """
+    if budget > 0:
+        script = ['(set-option :rlimit {})\n'.format(int(budget))]
+    else:
+        script = ['(set-option :timeout {})\n'.format(int(timeout * 1000))]
+    with open(smt_file, 'r') as f:
+        for line in f:
+            if 'check-sat' in line:
+                if strategy is not None:
+                    line = '(check-sat-using %s)\n' % strategy
+                line += '(get-info :all-statistics)\n'
+            script.append(line)
+
+    ctx = z3.Context()
+    time_before = time.time()
+    try:
+        out = z3.Z3_eval_smtlib2_string(ctx.ref(), ''.join(script))
+    except z3.Z3Exception:
+        out = 'unknown'
+    time_after = time.time()
+    del ctx
+
+    res, rlimit = parse_output(out.strip())
+    return res, rlimit, time_after - time_before
+
+
+def _api_worker(conn):
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        conn.send(api_solve(*task))
+
+
+class ApiWorker:
+    """ Forked worker process which stays warm across benchmarks and solves them with api_solve. """
+
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        conn, child_conn = multiprocessing.get_context('fork').Pipe()
+        self.conn = conn
+        self.p = multiprocessing.get_context('fork').Process(target=_api_worker, args=(child_conn,), daemon=True)
+        self.p.start()
+        child_conn.close()
+
+    def solve(self, smt_file, strategy, timeout, grace=1, budget=0):
+        """ Returns (result, rlimit, time), the worker is killed and replaced if z3 misses the deadline. """
+        self.conn.send((smt_file, strategy, timeout, budget))
+        if self.conn.poll(timeout + grace):
+            return self.conn.recv()
+        os.kill(self.p.pid, signal.SIGKILL)
+        self.p.join()
+        self.conn.close()
+        self.start()
+        return None, None, None
+
+    def close(self):
+        self.conn.send(None)
+        self.p.join()
+        self.conn.close()
+
+
+class ApiRunner(threading.Thread):
+    """ Runner which executes a single tactic on a single goal in one of the warm ApiWorkers. """
+
+    def __init__(self, workers, smt_file, timeout, strategy=None, grace=1, budget=0):
+        threading.Thread.__init__(self)
+        self.workers = workers
+        self.smt_file = smt_file
+        self.timeout = timeout
+        self.strategy = strategy
+        self.grace = grace
+        self.budget = budget
+        self.new_file_name = smt_file
+        self.result = None
+        self.on_done = None
 
-        lines = out[:-1].decode("utf-8").split('\n')
-        res = lines[0]
+    def run(self):
+        worker = self.workers.get()
+        try:
+            self.result = worker.solve(self.smt_file, self.strategy, self.timeout, self.grace, self.budget)
+        finally:
+            self.workers.put(worker)
+        if self.on_done is not None:
+            self.on_done(self)
 
-        rlimit = None
-        for line in lines:
-            if 'rlimit' in line:
-                tokens = line.split(' ')
-                for token in tokens:
-                    if token.isdigit():
-                        rlimit = int(token)
+    def collect(self):
+        self.join()
+        res, rlimit, rtime = self.result
+        if res is None:
+            return None, None, None
+        return res, rlimit, rtime
+
+
+class CachedRunner:
+    """ Runner which replays a result from the result cache, or runs and records it otherwise. """
+
+    def __init__(self, cache, smt_file, timeout, strategy=None, id=1, grace=1, workers=None, budget=0):
+        self.cache = cache
+        engine = 'z3 -smt2 ' if workers is None else 'z3 api '
+        self.key = (file_hash(smt_file), engine + (strategy.strip() if strategy is not None else 'default'), timeout)
+        self.budget = budget
+        self.value = cache.get(*self.key, budget=budget)
+        self.runner = None
+        self.on_done = None
+        if self.value is None:
+            if workers is None:
+                self.runner = Z3Runner(smt_file, timeout, strategy, id, grace, budget)
+            else:
+                self.runner = ApiRunner(workers, smt_file, timeout, strategy, grace, budget)
+        self.new_file_name = self.runner.new_file_name if self.runner is not None else smt_file
+
+    def start(self):
+        if self.runner is None:
+            if self.on_done is not None:
+                self.on_done(self)
+            return
+        if self.on_done is not None:
+            self.runner.on_done = lambda _: self.on_done(self)
+        self.runner.start()
+
+    def join(self, timeout=None):
+        if self.runner is not None:
+            self.runner.join(timeout)
 
-        if res == 'unknown':
-            res = None
+    def collect(self):
+        if self.runner is None:
+            res, rlimit, rtime, _ = self.value
+            return (None if res == 'unknown' else res), rlimit, rtime
+        res, rlimit, rtime = self.runner.collect()
+        self.cache.put(*self.key, ('unknown' if res is None else res, rlimit, rtime, None), budget=self.budget)
+        return res, rlimit, rtime
+
+
+class BaselineRunner:
+    """ Runner which replays the default z3 result of a benchmark from the baseline table, or runs it with
+    the engine of the learned strategy and records it otherwise, so both columns are measured the same way. """
+
+    def __init__(self, table, engine, smt_file, timeout, budget, make_runner):
+        self.table = table
+        self.key = (file_hash(smt_file), timeout)
+        self.budget = budget
+        self.engine = engine
+        self.value = table.get(*self.key, budget, engine)
+        self.runner = make_runner() if self.value is None else None
+        self.on_done = None
+        self.new_file_name = self.runner.new_file_name if self.runner is not None else smt_file
+
+    def start(self):
+        if self.runner is None:
+            if self.on_done is not None:
+                self.on_done(self)
+            return
+        if self.on_done is not None:
+            self.runner.on_done = lambda _: self.on_done(self)
+        self.runner.start()
+
+    def join(self, timeout=None):
+        if self.runner is not None:
+            self.runner.join(timeout)
 
-        return res, rlimit, self.time_after - self.time_before
+    def collect(self):
+        if self.runner is None:
+            res, rlimit, rtime = self.value
+            return (None if res == 'unknown' else res), rlimit, rtime
+        res, rlimit, rtime = self.runner.collect()
+        self.table.put(*self.key, ('unknown' if res is None else res, rlimit, rtime), self.budget, self.engine)
+        return res, rlimit, rtime
+
+
+class RunnerPool:
+    """ Keeps a fixed number of runners busy, the next runner is started as soon as any runner finishes. """
+
+    def __init__(self, size):
+        self.size = size
+        self.done = queue.Queue()
+
+    def run(self, jobs):
+        """ Starts runners created by jobs and yields them in completion order.
+
+        :param jobs: iterable of (key, function returning a not yet started runner)
+        :return: generator of (key, finished runner)
+        """
+        jobs = iter(jobs)
+        running = 0
+        while True:
+            while running < self.size:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                key, make_runner = job
+                runner = make_runner()
+                runner.on_done = lambda r, key=key: self.done.put((key, r))
+                runner.start()
+                running += 1
+            if running == 0:
+                return
+            key, runner = self.done.get()
+            running -= 1
+            runner.join()
+            yield key, runner
 
 
 def main():
@@ -90,8 +329,33 @@ def main():
     parser.add_argument('--benchmark_dir', type=str, help='Directory which contains benchmark files')
     parser.add_argument('--max_timeout', type=int, help='Maximum runtime for solver')
     parser.add_argument('--batch_size', type=int, default=1, help='Number of benchmarks to evaluate in parallel')
+    parser.add_argument('--grace', type=float, default=1, help='Seconds between SIGTERM and SIGKILL of a timed out z3')
+    parser.add_argument('--result_cache', type=str, default=None, help='Database of solver results shared between runs')
+    parser.add_argument('--engine', type=str, default='cli', choices=['cli', 'api'],
+                        help='Run z3 binary per benchmark (cli) or z3 API in warm worker processes (api)')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Database of default z3 results per file and engine, the Z3 column is read from it '
+                             'and only missing files are run with the engine')
+    parser.add_argument('--rlimit_budget', type=int, default=0,
+                        help='Stop z3 at this rlimit, max_timeout only remains as the deadline after which it is killed')
     args = parser.parse_args()
 
+    cache = ResultCache(args.result_cache) if args.result_cache is not None else None
+
+    workers = None
+    if args.engine == 'api':
+        workers = queue.Queue()
+        for _ in range(2 * args.batch_size):
+            workers.put(ApiWorker())
+
+    def make_runner(smt_file, strategy=None, id=1):
+        if cache is not None:
+            return CachedRunner(cache, smt_file, args.max_timeout, strategy, id=id, grace=args.grace, workers=workers,
+                                budget=args.rlimit_budget)
+        if workers is not None:
+            return ApiRunner(workers, smt_file, args.max_timeout, strategy, grace=args.grace, budget=args.rlimit_budget)
+        return Z3Runner(smt_file, args.max_timeout, strategy, id=id, grace=args.grace, budget=args.rlimit_budget)
+
     strategy = None
     if args.strategy_file is not None:
         with open(args.strategy_file, 'r') as f:
@@ -106,85 +370,98 @@ def main():
     only_z3 = 0
     none_solved = 0
 
+    false_res = 0
+
+    def print_summary():
+        print('==========================================')
+        print('Both solved:',len(speedups))
+        print('Only learned solved: ',only_learned)
+        print('Only Z3 solved: ',only_z3)
+        print('None solved:',none_solved)
+        print("False Result:", false_res)
+        print('-> Speedup (number of operations):')
+        if len(speedups) > 0:
+            speedups.sort()
+            print('Average speedup: ',np.mean(speedups))
+            for p in PER:
+                print('Percentile ',p,': ',speedups[int(p*len(speedups))])
+        print('-> Speedup (wall clock time):')
+        if len(speedups_real) > 0:
+            speedups_real.sort()
+            print('Average speedup: ',np.mean(speedups_real))
+            for p in PER:
+                print('Percentile ',p,': ',speedups_real[int(p*len(speedups_real))])
+
+    smt_files = []
     for root, directories, filenames in os.walk(args.benchmark_dir):
-        for i in range(0, len(filenames), args.batch_size):
-            tasks1 = []
-            tasks2 = []
-
-            for j in range(i, min(len(filenames), i + args.batch_size)):
-                file = filenames[j]
-                if not file.endswith('smt2'):
-                    continue
-
-                smt_file = os.path.join(args.benchmark_dir, file)
-
-                thread1 = Z3Runner(smt_file, args.max_timeout, strategy, id=j-i+1)
-                thread1.start()
-
-                thread2 = Z3Runner(smt_file, args.max_timeout)
-                thread2.start()
-
-                tasks1.append(thread1)
-                tasks2.append(thread2)
-
-            time_start = time.time()
-            false_res = 0
-            for task1, task2 in zip(tasks1, tasks2):
-                time_left = max(0, args.max_timeout - (time.time() - time_start))
-                task1.join(time_left)
-                time_left = max(0, args.max_timeout - (time.time() - time_start))
-                task2.join(time_left)
-
-                res1, rlimit1, time1 = task1.collect()
-                res2, rlimit2, time2 = task2.collect()
-                
-                print('Learned: ',res1, rlimit1, '\tZ3: ', res2, rlimit2)
-                if res1 is not None and res2 is not None and res1 != res2:
-                    print(res1, res2)
-                    print('Inconsistent result detected, skipping!')
-                    print(task1.new_file_name)
-                    print(task2.new_file_name)
-                    false_res+=1
-                    # exit(0)
-                    continue
-
-                if res1 is not None:
-                    if res2 is None:
-                        only_learned += 1
-                    ok1 += 1
-                if res2 is not None:
-                    if res1 is None:
-                        only_z3 += 1
-                    okd += 1
-                if res1 is None and res2 is None:
-                    none_solved += 1
-
-                if res1 is not None and res2 is not None:
-                    if rlimit1 is not None and rlimit2 is not None:
-                        speedup = rlimit2 / float(rlimit1)
-                        speedups.append(speedup)
-                    speedup_real = time2 / float(time1)
-                    speedups_real.append(speedup_real)
-
-
-            print('==========================================')
-            print('Both solved:',len(speedups))
-            print('Only learned solved: ',only_learned)
-            print('Only Z3 solved: ',only_z3)
-            print('None solved:',none_solved)
-            print("False Result:", false_res)
-            print('-> Speedup (number of operations):')
-            if len(speedups) > 0:
-                speedups.sort()
-                print('Average speedup: ',np.mean(speedups))
-                for p in PER:
-                    print('Percentile ',p,': ',speedups[int(p*len(speedups))])
-            print('-> Speedup (wall clock time):')
-            if len(speedups_real) > 0:
-                speedups_real.sort()
-                print('Average speedup: ',np.mean(speedups_real))
-                for p in PER:
-                    print('Percentile ',p,': ',speedups_real[int(p*len(speedups_real))])
+        for file in filenames:
+            if file.endswith('smt2'):
+                smt_files.append(os.path.join(args.benchmark_dir, file))
+
+    table = BaselineTable(args.baseline) if args.baseline is not None else None
+    engine = 'z3 -smt2' if workers is None else 'z3 api'
+
+    # both runs of every benchmark share one pool, so batch_size benchmarks keep 2 * batch_size z3 processes busy
+    jobs = []
+    for j, smt_file in enumerate(smt_files):
+        jobs.append(((j, 0), lambda smt_file=smt_file, j=j: make_runner(smt_file, strategy, id=j)))
+        if table is not None:
+            jobs.append(((j, 1), lambda smt_file=smt_file: BaselineRunner(
+                table, engine, smt_file, args.max_timeout, args.rlimit_budget, lambda: make_runner(smt_file))))
+        else:
+            jobs.append(((j, 1), lambda smt_file=smt_file: make_runner(smt_file)))
+
+    finished = {}
+    n_done = 0
+    for (j, k), runner in RunnerPool(2 * args.batch_size).run(jobs):
+        finished.setdefault(j, {})[k] = runner
+        if len(finished[j]) < 2:
+            continue
+        task1, task2 = finished[j][0], finished.pop(j)[1]
+        n_done += 1
+
+        res1, rlimit1, time1 = task1.collect()
+        res2, rlimit2, time2 = task2.collect()
+
+        print('Learned: ',res1, rlimit1, '\tZ3: ', res2, rlimit2)
+        if res1 is not None and res2 is not None and res1 != res2:
+            print(res1, res2)
+            print('Inconsistent result detected, skipping!')
+            print(task1.new_file_name)
+            print(task2.new_file_name)
+            false_res+=1
+            # exit(0)
+        else:
+            if res1 is not None:
+                if res2 is None:
+                    only_learned += 1
+                ok1 += 1
+            if res2 is not None:
+                if res1 is None:
+                    only_z3 += 1
+                okd += 1
+            if res1 is None and res2 is None:
+                none_solved += 1
+
+            if res1 is not None and res2 is not None:
+                if rlimit1 is not None and rlimit2 is not None:
+                    speedup = rlimit2 / float(rlimit1)
+                    speedups.append(speedup)
+                speedup_real = time2 / float(time1)
+                speedups_real.append(speedup_real)
+
+        if n_done % args.batch_size == 0 or n_done == len(smt_files):
+            print_summary()
+
+    if workers is not None:
+        while not workers.empty():
+            workers.get().close()
+
+    if cache is not None:
+        print(cache.stats())
+        cache.close()
+    if table is not None:
+        table.close()
 
 if __name__ == '__main__':
     main()
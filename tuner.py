@@ -19,33 +19,19 @@ import random
 from utils.strategy import StrategyEnumerator
 import torch
 from torch import nn
-import timeout_decorator
 import z3
 import queue
-import heapq
 import json
 import os
-import re
-from fastsmt.language import objects
-from agent import SMTSolver
-
-
-BV_THEORY = [
-    'bvadd', 'bvsub', 'bvneg', 'bvmul', 'bvurem', 'bvsrem', 'bvsmod',
-    'bvshl', 'bvlshr', 'bvashr', 'bvor', 'bvand', 'bvnand', 'bvnor',
-    'bvxnor', 'bvule', 'bvult', 'bvugt', 'bvuge', 'bvsle', 'bvslt',
-    'bvsge', 'bvsgt', 'bvudiv', 'extract', 'bvudiv_i', 'bvnot',
-]
-
-ST_TOKENS = [
-    '=', '<', '>', '==', '>=', '<=', '=>', '+', '-', '*', '/',
-    'true', 'false', 'not', 'and', 'or', 'xor',
-    'zero_extend', 'sign_extend', 'concat', 'let', '_', 'ite',
-    'exists', 'forall', 'assert', 'declare-fun', 
-    'Int', 'Bool', 'BitVec',
-]
-
-ALL_TOKENS = ["UNK"] + ST_TOKENS + BV_THEORY
+import sys
+from language import objects
+from agent import GoalTokenizer, SMTSolver
+from utils.baseline import BaselineTable, compute_baseline
+from utils.cache import ResultCache, strategy_key
+from utils.capping import Capping
+from utils.param_search import ParamSpace, TPE, TrialHistory
+from utils.probes import default_features
+from utils import parallel
 
 
 def uniq_list(lst):
@@ -56,44 +42,35 @@ def uniq_list(lst):
     return n_lst
 
 
-class GoalTokenizer(object):
-    def __init__(self):
-        self.token_idx = {}
-        for i, token in enumerate(ALL_TOKENS):
-            self.token_idx[token] = i
-
-    def bow(self, formula):
-        if type(formula) is not str:
-            formula = str(formula)
-        digit = re.compile("\d+")
-        formula = re.sub('[\(\)\n]', ' ', formula)
-        formula = re.sub('\[|\]|\,', '', formula)
-        formula = re.sub('[ ]+', ' ', formula)
-
-        tokens = formula.split(' ')
-
-        ret = [0 for i in ALL_TOKENS]
-        for token in tokens:
-            if token not in self.token_idx:
-                ret[0] += 1
-            else:
-                ret[self.token_idx[token]] += 1
-        return ret
-
-
 import time
 
 class Tuner:
-    def __init__(self, config):
+    def __init__(self, config, result_cache=None, baseline=None, baseline_workers=1, workers=1,
+                 param_search='random', param_trials=20, param_batch=4, history=None, rlimit_budget=0):
+        self.config = config
+        self.workers = workers
+        self.param_search = param_search
+        self.param_trials = param_trials
+        self.param_batch = param_batch
+        self.history = history
+        self.capping = Capping.from_config(config)
         self.enumerator = StrategyEnumerator(**config["tactics_config"])
         self.tokenizer = GoalTokenizer()
-        self.solver = SMTSolver(self.tokenizer, self.enumerator)
-
-    def solve(self, formula, tactic, use_rlimit=True):
+        self.solver = SMTSolver(self.tokenizer, self.enumerator, result_cache, rlimit_budget=rlimit_budget)
+        self.baseline = baseline
+        self.baseline_workers = baseline_workers
+
+    def solve(self, formula, tactic, use_rlimit=True, cap=None):
+        if self.solver.cache is not None and not isinstance(tactic, z3.Tactic):
+            res, rlimit, rtime, _ = self.solver.solve_cached(formula, tactic, cap=cap)
+            return res, formula, rtime if not use_rlimit else rlimit
+        if isinstance(formula, str):
+            formula = z3.parse_smt2_file(formula)
+        if not isinstance(tactic, (str, z3.Tactic)):
+            tactic = tactic.tactic
         if type(tactic) is str:
             tactic = z3.Tactic(tactic)
-        tactic = z3.TryFor(tactic, 5000)
-        s = tactic.solver()
+        s = self.solver.make_solver(tactic, cap=cap)
 
         s.add(formula)
         r_before = self.solver.get_rlimit(s)
@@ -106,11 +83,7 @@ class Tuner:
         return str(res), s.assertions(), t_after-t_before if not use_rlimit else r_after-r_before
 
     def get_probes(self, formula):
-        goal = z3.Goal()
-        goal.add(formula)
-        probes = [z3.Probe(p) for p in z3.probes()]
-        ng = goal.as_expr()
-        probes = [p(ng) for p in probes]
+        probes = default_features().features(formula).tolist()
         return probes + self.tokenizer.bow(formula)
 
     def random_params(self, tactic):
@@ -153,11 +126,15 @@ class Tuner:
         for seq in tac_sequence:
             seq = [objects.Tactic(tac) for tac in seq]
             tsp.append(seq)
+            if self.param_search != 'random':
+                continue
             n_seq = [self.random_params(tac.s) for tac in seq]
             if str_tactic_seq(n_seq) == str_tactic_seq(seq):
                 continue
             for i in range(10):
                 tsp.append([self.random_params(tac.s) for tac in seq])
+        if self.param_search == 'tpe':
+            tsp += self.search_params(smt_instances, tac_sequence, self.param_trials)
 
         tsp.sort(key=cmp_to_key(comp))
         # for i in tsp:
@@ -173,36 +150,233 @@ class Tuner:
         if quick_tuner or cnt == len(tsp):
             return tsp
 
-        print("uniq tactic_seq: {}".format(len(tsp)))
-        formulas = [z3.parse_smt2_file(smt_instance) for smt_instance in smt_instances]
-        for ts in res:
-            print([(x.s, x.params) if isinstance(x, objects.With) else x.s for x in ts])
-        heap = []
-        print("=================has {} method to use, shrink to {} method".format(len(res), cnt))
-        for i, ts in enumerate(res):
-            print("=======use method", i, "solve formula")
-            tot_time = 0
-            t_tac = objects.AndThen(*ts).tactic if len(ts) > 1 else ts[0].tactic
-            for k, formula in enumerate(formulas):
-                if k % 2 == 0:
-                    print("try to solve", k, "th formula")
-                
-                rres, formula, time = self.solve(formula, t_tac)
-                if rres is 'unknown':
-                    tot_time += 5500000
+        print("uniq tactic_seq: {}".format(len(tsp)), file=sys.stderr)
+        return self.race(smt_instances, tsp, cnt)
+
+    def race(self, smt_instances, tsp, cnt, eta=2):
+        """ Selects the cnt tactic sequences with the lowest total cost on smt_instances by successive halving.
+
+        Every round evaluates the surviving sequences on the next block of formulas (in parallel over
+        self.workers processes) and keeps the best max(cnt, 1/eta) of them by their cost on all formulas
+        seen so far. Blocks grow by eta, so the final cnt sequences are ranked on all formulas while most
+        others are dropped after a small fraction of them.
+        """
+        if cnt < 1:
+            return []
+        n = len(smt_instances)
+        rounds = 0
+        while len(tsp) > cnt * eta ** rounds:
+            rounds += 1
+
+        cell_cost = self.cell_cost_fn(smt_instances)
+        packed = [[str(tac) for tac in ts] for ts in tsp]
+        totals = [0.0 for _ in tsp]
+        alive = list(range(len(tsp)))
+        done = 0
+        print("=================has {} method to use, shrink to {} method".format(len(tsp), cnt), file=sys.stderr)
+        for r in range(rounds + 1):
+            end = n if r == rounds else max(done, -(-n // eta ** (rounds - r)))
+            costs = self.evaluate(smt_instances, [packed[i] for i in alive], cell_cost, done, end)
+            for i, cost in zip(alive, costs):
+                totals[i] += cost
+            done = end
+
+            alive.sort(key=lambda i: totals[i])
+            if r < rounds:
+                alive = alive[:max(cnt, -(-len(alive) // eta))]
+            print("race round {}: {} formulas, {} methods left".format(r, done, len(alive)), file=sys.stderr)
+        if self.capping.enabled:
+            print("{} evaluations capped".format(self.capping.capped_cnt), file=sys.stderr)
+
+        return [tsp[i] for i in alive[:cnt]]
+
+    def cell_cost_fn(self, smt_instances):
+        """ Returns function mapping (result, cost, formula index) of a single solver call to its cost.
+        With a baseline table methods are ranked by their cost relative to the default z3 solver. """
+        base_costs = None
+        if self.baseline is not None:
+            timeout, budget = self.solver.limits()
+            baseline = compute_baseline(smt_instances, timeout, self.baseline, self.baseline_workers, budget)
+            base_costs = [max(baseline[smt_instance][1], 1) for smt_instance in smt_instances]
+
+        def cell_cost(res, cost, k):
+            if base_costs is not None:
+                return 10 if res == 'unknown' else cost / base_costs[k]
+            return 5500000 if res == 'unknown' else cost
+        return cell_cost
+
+    def evaluate(self, smt_instances, packed, cell_cost, start=0, end=None):
+        """ Returns total cost of every tactic sequence of packed (lists of tactic strings) on
+        smt_instances[start:end], solved on self.workers processes.
+
+        With capping enabled a formula without known best cost is solved by one sequence at a time (packed[0]
+        first) until one of them solves it, the other sequences get a budget derived from the best cost and
+        count as unsolved when they exceed it.
+        """
+        end = len(smt_instances) if end is None else end
+        result_cache = self.solver.cache.path if self.solver.cache is not None else None
+        totals = [0.0 for _ in packed]
+
+        def make_task(i, k):
+            return i, packed[i], smt_instances[k], k, self.capping.budget(smt_instances[k])
+
+        pending = {}
+
+        def expand(task, res):
+            _, _, smt_instance, k, budget = task
+            if budget is not None or len(pending.get(k, [])) == 0:
+                return []
+            if res[0] != 'sat' and res[0] != 'unsat':
+                # the next sequence takes over until one of them solves the formula
+                return [make_task(pending[k].pop(0), k)]
+            self.capping.observe(smt_instance, res[0], res[1])
+            n_tasks = [make_task(i, k) for i in pending[k]]
+            pending[k] = []
+            return n_tasks
+
+        initargs = (self.config, result_cache, self.solver.rlimit_budget)
+        if self.capping.enabled:
+            tasks = []
+            for k in range(start, end):
+                if self.capping.budget(smt_instances[k]) is None:
+                    tasks.append(make_task(0, k))
+                    pending[k] = list(range(1, len(packed)))
                 else:
-                    tot_time += time
-            heapq.heappush(heap, (tot_time, i))
+                    tasks += [make_task(i, k) for i in range(len(packed))]
+            results = parallel.expand_tasks(_tune_task, tasks, expand, self.workers, _init_tune_worker, initargs)
+        else:
+            tasks = [make_task(i, k) for i in range(len(packed)) for k in range(start, end)]
+            results = parallel.imap_tasks(_tune_task, tasks, self.workers, _init_tune_worker, initargs)
+
+        for (i, _, smt_instance, k, budget), (res, cost, hits, misses) in results:
+            if self.solver.cache is not None:
+                # lookups are made by the cache of the worker, the statistics are kept here
+                self.solver.cache.hits += hits
+                self.solver.cache.misses += misses
+            if self.capping.capped(res, cost, budget):
+                res = 'unknown'
+            self.capping.observe(smt_instance, res, cost)
+            totals[i] += cell_cost(res, cost, k)
+        return totals
+
+    def search_params(self, smt_instances, tac_sequence, trials, keep=10, eta=2, blocks=4):
+        """ Searches parameters of the With tactics of every sequence of tac_sequence (lists of tactic names)
+        with a TPE model and returns the keep best instantiations of each sequence.
+
+        All sequences are searched side by side, every round evaluates param_batch proposals per sequence
+        in one batch on self.workers processes until trials new points per sequence are evaluated. Points of
+        earlier runs found in self.history are evaluated first (mostly from the result cache) to warm up
+        the models.
+
+        Proposals are raced on blocks of formulas growing by eta, the first one holding 1/eta**(blocks-1)
+        of them. A proposal is dropped after the block on which its total cost exceeds the one of the best
+        point of its sequence on the same formulas, its cost is then extrapolated to all formulas but kept
+        above the one of that best point.
+        """
+        n = len(smt_instances)
+        if n == 0:
+            return []
+        cell_cost = self.cell_cost_fn(smt_instances)
+        spaces = [ParamSpace(self.enumerator, tactics) for tactics in tac_sequence]
+        spaces = [space for space in spaces if len(space) > 0]
+        models = [TPE(space.is_bool, seed=random.randrange(1 << 30)) for space in spaces]
+        seen = [{} for _ in spaces]
+        budget = [trials for _ in spaces]
+        ends = sorted(set(-(-n // eta ** r) for r in range(blocks)))
+        # total costs at the ends of the blocks of the best point of every sequence evaluated on all formulas
+        incumbents = [None for _ in spaces]
+
+        def run(batch):
+            packed = [[str(tac) for tac in spaces[j].tactic_seq(x)] for j, x in batch]
+            totals = [[] for _ in batch]
+            alive = list(range(len(batch)))
+            start = 0
+            for b, end in enumerate(ends):
+                costs = self.evaluate(smt_instances, [packed[i] for i in alive], cell_cost, start, end)
+                for i, cost in zip(alive, costs):
+                    totals[i].append(cost + (totals[i][-1] if b > 0 else 0.0))
+                start = end
+                alive = [i for i in alive if incumbents[batch[i][0]] is None
+                         or totals[i][b] <= incumbents[batch[i][0]][b]]
+            for (j, x), tac_seq, total in zip(batch, packed, totals):
+                cost = total[-1]
+                if len(total) < len(ends):
+                    cost = max(cost * n / ends[len(total) - 1], incumbents[j][-1])
+                models[j].tell(x, cost)
+                seen[j][strategy_key(tac_seq)] = (cost, x)
+                if len(total) == len(ends) and (incumbents[j] is None or total[-1] < incumbents[j][-1]):
+                    incumbents[j] = total
+                if self.history is not None:
+                    self.history.put(spaces[j].key(), tac_seq, x)
+            if self.history is not None:
+                self.history.flush()
+            return len(batch) - sum(len(total) == len(ends) for total in totals)
+
+        if self.history is not None:
+            batch = []
+            for j, space in enumerate(spaces):
+                batch += [(j, x) for x in self.history.get(space.key()) if len(x) == len(space)]
+            if len(batch) > 0:
+                print("evaluate {} stored parameter points".format(len(batch)), file=sys.stderr)
+                run(batch)
+
+        rnd = 0
+        while True:
+            batch = []
+            for j, space in enumerate(spaces):
+                n = min(self.param_batch, budget[j])
+                if n == 0:
+                    continue
+                keys = set()
+                for x in models[j].ask(n):
+                    key = strategy_key(space.tactic_seq(x))
+                    if key in seen[j] or key in keys:
+                        continue
+                    keys.add(key)
+                    batch.append((j, x))
+                    if len(keys) == n:
+                        break
+                # the space is exhausted when no candidate is a new instantiation
+                budget[j] = budget[j] - len(keys) if len(keys) > 0 else 0
+            if len(batch) == 0:
+                break
+            dropped = run(batch)
+            rnd += 1
+            print("param search round {}: {} points, {} raced out, sum of best costs {}".format(
+                rnd, len(batch), dropped, sum(min(c for c, _ in sn.values()) for sn in seen if len(sn) > 0)),
+                file=sys.stderr)
 
-        tsp = res
-        
         res = []
-        for i in range(min(cnt, len(heap))):
-            _, ts = heapq.heappop(heap)
-            res.append(tsp[ts])
-
+        for space, sn in zip(spaces, seen):
+            best = sorted(sn.values(), key=lambda v: v[0])[:keep]
+            res += [space.tactic_seq(x) for _, x in best]
         return res
 
+
+_tune_tuner = None
+
+
+def _init_tune_worker(config, result_cache=None, rlimit_budget=0):
+    global _tune_tuner
+    cache = ResultCache(result_cache) if result_cache is not None else None
+    if cache is not None:
+        # results are committed in batches, the last one once the pool is done
+        parallel.at_exit(cache.close)
+    _tune_tuner = Tuner(config, cache, rlimit_budget=rlimit_budget)
+
+
+def _tune_task(task):
+    _, tac_seq, smt_instance, _, budget = task
+    ts = [objects.from_string(tac) for tac in tac_seq]
+    t_tac = objects.AndThen(*ts) if len(ts) > 1 else ts[0]
+    cache = _tune_tuner.solver.cache
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    res, _, cost = _tune_tuner.solve(smt_instance, t_tac, cap=budget)
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    return res, cost, hits, misses
+
+
 import argparse
 
 
@@ -215,11 +389,29 @@ def main():
     parser.add_argument('--mode', type=str, default='tuner')
     parser.add_argument('--quick_tuner', type=bool, default=True)
     parser.add_argument('--out_file', type=str, default=None)
+    parser.add_argument('--result_cache', type=str, default=None, help='Database of solver results shared between runs')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Database of default z3 results per file, defaults to the result cache database')
+    parser.add_argument('--baseline_workers', type=int, default=1, help='Number of processes computing the baseline')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes evaluating methods when not quick')
+    parser.add_argument('--param_search', type=str, default='random', choices=['random', 'tpe'],
+                        help='Instantiate With parameters at random or search them with a TPE model')
+    parser.add_argument('--param_trials', type=int, default=20, help='Number of TPE evaluations per tactic sequence')
+    parser.add_argument('--param_batch', type=int, default=4, help='Number of TPE proposals per sequence and round')
+    parser.add_argument('--rlimit_budget', type=int, default=0,
+                        help='z3 rlimit of every solver call instead of the 5 second timeout, 0 keeps the timeout')
 
     args = parser.parse_args()
+    if args.param_search == 'tpe' and args.quick_tuner:
+        parser.error("--param_search tpe evaluates every proposal, use it with --quick_tuner ''")
 
     data = []
-    tuner = Tuner(json.load(open(args.configuration, 'r')))
+    result_cache = ResultCache(args.result_cache) if args.result_cache is not None else None
+    baseline_path = args.baseline if args.baseline is not None else args.result_cache
+    baseline = BaselineTable(baseline_path) if baseline_path is not None else None
+    history = TrialHistory(args.result_cache) if args.result_cache is not None else None
+    tuner = Tuner(json.load(open(args.configuration, 'r')), result_cache, baseline, args.baseline_workers, args.workers,
+                  args.param_search, args.param_trials, args.param_batch, history, args.rlimit_budget)
     for root, directories, filenames in os.walk(args.train_data):
         for file in filenames:
             if file.endswith('.smt2'):
@@ -252,6 +444,15 @@ def main():
             f.write(str([str(tt) for tt in ls]))
             f.write('\n')
 
+    if result_cache is not None:
+        # stdout is the tactic file consumed by combiner.py
+        print(result_cache.stats(), file=sys.stderr)
+        result_cache.close()
+    if baseline is not None:
+        baseline.close()
+    if history is not None:
+        history.close()
+
 
 if __name__ == '__main__':
     main()
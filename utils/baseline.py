@@ -0,0 +1,132 @@
+"""
+Copyright 2023 WHN
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sqlite3
+import sys
+import time
+
+import z3
+
+from utils import parallel
+from utils.cache import create_table, file_hash
+
+
+class BaselineTable:
+    """ Results of the default z3 solver per benchmark file, shared by agent, tuner and validate.
+
+    Entries are keyed by (file hash, z3 version, timeout, rlimit budget, engine) and hold (result, rlimit, time
+    in seconds). The engine tells how z3 was run, 'solver' for solve_default, validate.py stores the results of
+    its own engines, which differ in start up time and in the handling of set-logic. The table can live in the
+    same database file as the ResultCache.
+    """
+
+    def __init__(self, path):
+        """ Opens (and creates if needed) baseline table.
+
+        :param path: path of the database file
+        """
+        self.path = path
+        self.z3_version = z3.get_version_string()
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        create_table(self.conn, 'baseline', ['file_hash TEXT', 'z3_version TEXT', 'timeout REAL', 'res TEXT',
+                                             'rlimit INTEGER', 'rtime REAL', 'budget INTEGER DEFAULT 0',
+                                             "engine TEXT DEFAULT 'solver'"],
+                     ['file_hash', 'z3_version', 'timeout', 'budget', 'engine'])
+        self.conn.commit()
+
+    def get(self, fh, timeout, budget=0, engine='solver'):
+        """ Returns stored (result, rlimit, time) or None. """
+        row = self.conn.execute('SELECT res, rlimit, rtime FROM baseline WHERE file_hash = ? AND z3_version = ? '
+                                'AND timeout = ? AND budget = ? AND engine = ?',
+                                (fh, self.z3_version, float(timeout), int(budget), engine)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def put(self, fh, timeout, value, budget=0, engine='solver'):
+        self.conn.execute('INSERT OR REPLACE INTO baseline VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (fh, self.z3_version, float(timeout)) + tuple(value) + (int(budget), engine))
+
+    def flush(self):
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def solve_default(smt_file, timeout, budget=0):
+    """ Solves a benchmark with the default z3 solver.
+
+    :param timeout: wall clock timeout in seconds, 0 for none
+    :param budget: z3 rlimit, 0 for none
+    :return: tuple (result, rlimit, time in seconds)
+    """
+    s = z3.Solver()
+    if timeout > 0:
+        s.set('timeout', int(timeout * 1000))
+    if budget > 0:
+        s.set('rlimit', int(budget))
+    s.add(z3.parse_smt2_file(smt_file))
+    t_before = time.time()
+    res = s.check()
+    t_after = time.time()
+    rlimit = 0
+    stats = s.statistics()
+    for i in range(len(stats)):
+        if stats[i][0] == 'rlimit count':
+            rlimit = stats[i][1]
+    return str(res), rlimit, t_after - t_before
+
+
+def _baseline_task(task):
+    return solve_default(*task)
+
+
+def compute_baseline(smt_files, timeout=5, table=None, workers=1, budget=0):
+    """ Returns {file: (result, rlimit, time)} of the default z3 solver. Files which are not in table are
+    solved on workers processes and stored, so a known dataset is looked up without running z3.
+
+    :param smt_files: list of .smt2 files
+    :param timeout: solver timeout in seconds
+    :param table: BaselineTable or None
+    :param workers: number of worker processes
+    :param budget: z3 rlimit of every call, 0 for none
+    """
+    res = {}
+    hashes = {}
+    missing = []
+    for smt_file in smt_files:
+        if table is not None:
+            hashes[smt_file] = file_hash(smt_file)
+            value = table.get(hashes[smt_file], timeout, budget)
+            if value is not None:
+                res[smt_file] = value
+                continue
+        missing.append((smt_file, timeout, budget))
+
+    if len(missing) > 0:
+        # stdout of the tuner is the tactic file consumed by combiner.py
+        print("solve {} of {} formulas with default z3 solver".format(len(missing), len(smt_files)), file=sys.stderr)
+    for i, ((smt_file, _, _), value) in enumerate(parallel.imap_tasks(_baseline_task, missing, workers)):
+        res[smt_file] = value
+        if table is not None:
+            table.put(hashes[smt_file], timeout, value, budget)
+        if i % 5 == 0:
+            print("evaluate {}th formula".format(i), file=sys.stderr)
+    if table is not None:
+        table.flush()
+    return res
@@ -0,0 +1,447 @@
+"""
+Copyright 2023 WHN
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+
+import z3
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+
+def strategy_key(tac_seq):
+    """ Returns canonical string of a tactic sequence, With parameters are already sorted by str(). """
+    return 'AndThen({})'.format(','.join(map(str, tac_seq)))
+
+
+def file_hash(path):
+    """ Returns sha1 of the file content. """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def goal_fingerprint(formula):
+    """ Returns fingerprint of a formula (expression, AST vector or goal) which is equal exactly for structurally
+    equal formulas of the same z3 context. z3 hash-conses terms, so this is the tuple of AST ids of the
+    assertions and costs O(number of assertions), independent of the size of the terms.
+
+    AST ids are recycled once terms are freed, so fingerprints are only comparable while both formulas are alive,
+    goal_hash gives keys which are stable across processes.
+    """
+    if isinstance(formula, (z3.Goal, z3.AstVector)):
+        return tuple(formula[i].get_id() for i in range(len(formula)))
+    return (formula.get_id(),)
+
+
+_goal_hashes = {}
+
+
+def _forget_goal_hash(key, ref):
+    value = _goal_hashes.get(key)
+    if value is not None and value[0] is ref:
+        del _goal_hashes[key]
+
+
+def goal_hash(formula):
+    """ Returns sha1 of a .smt2 file (given by path) or of the s-expression of a formula.
+
+    Hashes of expressions and AST vectors are memoized by fingerprint while the formula object is alive, so
+    repeated lookups of a goal do not print it again.
+    """
+    if isinstance(formula, str):
+        return file_hash(formula)
+    if isinstance(formula, z3.Goal):
+        # the s-expression of a goal also contains its depth and precision
+        return hashlib.sha1(formula.sexpr().encode('utf-8')).hexdigest()
+
+    key = (type(formula), formula.ctx.ref().value) + goal_fingerprint(formula)
+    value = _goal_hashes.get(key)
+    if value is not None and value[0]() is not None:
+        return value[1]
+    h = hashlib.sha1(formula.sexpr().encode('utf-8')).hexdigest()
+    ref = weakref.ref(formula, lambda r, key=key: _forget_goal_hash(key, r))
+    _goal_hashes[key] = (ref, h)
+    return h
+
+
+def create_table(conn, table, columns, key):
+    """ Creates table if needed. Tables of older versions which lack some of the columns, e.g. the budget
+    column (the z3 rlimit a result was obtained with, 0 for wall clock timeouts), are rebuilt with the
+    defaults of the missing columns, since SQLite can not change a primary key in place.
+
+    :param conn: sqlite3 connection
+    :param table: name of the table
+    :param columns: column definitions
+    :param key: list of primary key columns
+    """
+    create = 'CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({}))'.format(table, ', '.join(columns), ', '.join(key))
+    old = [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+    if len(old) > 0 and any(column.split()[0] not in old for column in columns):
+        conn.execute('ALTER TABLE {0} RENAME TO {0}_old'.format(table))
+        conn.execute(create)
+        conn.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {0}_old'.format(table, ', '.join(old)))
+        conn.execute('DROP TABLE {}_old'.format(table))
+    conn.execute(create)
+
+
+def checksum(strategy, fh, value):
+    return zlib.crc32('{}\x00{}\x00{}'.format(strategy, fh, value).encode('utf-8'))
+
+
+class SolveCache:
+    """ On-disk store of solve results backed by SQLite.
+
+    Records are keyed by (kind, strategy, file hash, z3 version, timeout, rlimit budget), so they stay valid when the
+    tactic file is reordered or extended. Every record carries a crc32 of its strategy, file and value, records
+    with a broken checksum are ignored on load and dropped by compact(). Writes are committed in
+    small batches, so an interrupted run only loses the uncommitted tail.
+    """
+
+    def __init__(self, path, timeout=5, flush_every=256, budget=0):
+        """ Opens (and creates if needed) cache database.
+
+        :param path: path of the database file
+        :param timeout: solver timeout in seconds that results were obtained with
+        :param flush_every: number of buffered records which triggers a commit
+        :param budget: z3 rlimit that results were obtained with, 0 if they are limited by timeout only
+        """
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                if f.read(len(SQLITE_HEADER)) != SQLITE_HEADER:
+                    raise ValueError('{} is not a solve cache database, old text caches have to be rebuilt'.format(path))
+
+        self.path = path
+        self.timeout = float(timeout)
+        self.budget = int(budget)
+        self.z3_version = z3.get_version_string()
+        self.flush_every = flush_every
+        self.pending = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        create_table(self.conn, 'results', ['kind TEXT', 'strategy TEXT', 'file_hash TEXT', 'z3_version TEXT',
+                                            'timeout REAL', 'value TEXT', 'crc INTEGER', 'budget INTEGER DEFAULT 0'],
+                     ['kind', 'strategy', 'file_hash', 'z3_version', 'timeout', 'budget'])
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                          'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, file_hash TEXT)')
+        create_table(self.conn, 'trees', ['kind TEXT', 'node TEXT', 'z3_version TEXT', 'timeout REAL', 'tree TEXT',
+                                          'budget INTEGER DEFAULT 0'],
+                     ['kind', 'node', 'z3_version', 'timeout', 'budget'])
+        self.conn.commit()
+        self.file_hashes = {}
+
+    def hash_files(self, paths):
+        """ Returns mapping from path to content hash, hashes are reused while mtime and size are unchanged. """
+        known = {}
+        for path, mtime, size, h in self.conn.execute('SELECT path, mtime, size, file_hash FROM files'):
+            known[path] = (mtime, size, h)
+
+        res = {}
+        updated = []
+        for path in paths:
+            st = os.stat(path)
+            old = known.get(path)
+            if old is not None and old[0] == st.st_mtime and old[1] == st.st_size:
+                res[path] = old[2]
+            else:
+                res[path] = file_hash(path)
+                updated.append((path, st.st_mtime, st.st_size, res[path]))
+        if len(updated) > 0:
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', updated)
+            self.conn.commit()
+        self.file_hashes.update(res)
+        return res
+
+    def load(self, kind):
+        """ Loads all valid records of given kind for current z3 version, timeout and budget.
+
+        :return: dict which maps (strategy, file hash) to stored value, None marks unsolved formulas
+        """
+        res = {}
+        broken = 0
+        rows = self.conn.execute('SELECT strategy, file_hash, value, crc FROM results '
+                                 'WHERE kind = ? AND z3_version = ? AND timeout = ? AND budget = ?',
+                                 (kind, self.z3_version, self.timeout, self.budget))
+        for strategy, fh, value, crc in rows:
+            if checksum(strategy, fh, value) != crc:
+                broken += 1
+                continue
+            res[(strategy, fh)] = json.loads(value)
+        if broken > 0:
+            print("skip {} broken cache records".format(broken))
+        return res
+
+    def put(self, kind, strategy, path, value):
+        """ Stores a single result, path has to be hashed before via hash_files. """
+        fh = self.file_hashes[path]
+        value = json.dumps(value)
+        self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (kind, strategy, fh, self.z3_version, self.timeout, value, checksum(strategy, fh, value),
+                           self.budget))
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def get_tree(self, kind, node):
+        """ Returns stored subtree (as json object) generated for a node with given key, or None. """
+        row = self.conn.execute('SELECT tree FROM trees WHERE kind = ? AND node = ? AND z3_version = ? AND timeout = ? '
+                                'AND budget = ?', (kind, node, self.z3_version, self.timeout, self.budget)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_tree(self, kind, node, tree):
+        self.conn.execute('INSERT OR REPLACE INTO trees VALUES (?, ?, ?, ?, ?, ?)',
+                          (kind, node, self.z3_version, self.timeout, json.dumps(tree), self.budget))
+        self.flush()
+
+    def flush(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def compact(self, keep_versions=False):
+        """ Drops broken records (and records of other z3 versions) and shrinks the database file. """
+        self.flush()
+        broken = []
+        for rowid, strategy, fh, value, crc in self.conn.execute(
+                'SELECT rowid, strategy, file_hash, value, crc FROM results'):
+            if checksum(strategy, fh, value) != crc:
+                broken.append((rowid,))
+        self.conn.executemany('DELETE FROM results WHERE rowid = ?', broken)
+        dropped = 0
+        if not keep_versions:
+            dropped = self.conn.execute('DELETE FROM results WHERE z3_version != ?', (self.z3_version,)).rowcount
+            self.conn.execute('DELETE FROM trees WHERE z3_version != ?', (self.z3_version,))
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+        total = self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        print("compact cache: drop {} broken and {} outdated records, {} left".format(len(broken), dropped, total))
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class ResultCache:
+    """ Content addressed cache of single solver calls, shared by agent, tuner, combiner and validate.
+
+    Entries map (goal hash, strategy, timeout, rlimit budget) of the current z3 version to a tuple
+    (result, rlimit, time, output goal hash), budget 0 marks results limited by the timeout only. Recently used entries are kept in memory, the optional
+    SQLite file makes results reusable across runs. Both are bounded by max_entries with LRU eviction.
+
+    Writes are buffered and committed together on flush, so a process only holds the write lock of a shared
+    database while flushing. The row count is read on open and kept up to date with the own writes, rows
+    added by other processes meanwhile are only counted by the next open.
+    """
+
+    def __init__(self, path=None, max_entries=1000000, flush_every=256):
+        """ Initializes object of type ResultCache.
+
+        :param path: path of the database file, None keeps results in memory only
+        :param max_entries: maximum number of entries kept in memory and on disk
+        :param flush_every: number of buffered writes which triggers a commit
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.z3_version = z3.get_version_string()
+        self.entries = OrderedDict()
+        self.touched = set()
+        self.pending = {}
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = None
+        if path is not None:
+            self.conn = sqlite3.connect(path, timeout=60)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            create_table(self.conn, 'solve_results',
+                         ['goal_hash TEXT', 'strategy TEXT', 'timeout REAL', 'z3_version TEXT', 'res TEXT',
+                          'rlimit REAL', 'rtime REAL', 'out_hash TEXT', 'used REAL', 'budget INTEGER DEFAULT 0'],
+                         ['goal_hash', 'strategy', 'timeout', 'budget', 'z3_version'])
+            self.conn.execute('CREATE INDEX IF NOT EXISTS solve_results_used ON solve_results (used)')
+            self.conn.commit()
+            self.rows = self.conn.execute('SELECT COUNT(*) FROM solve_results').fetchone()[0]
+
+    def remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, goal_hash, strategy, timeout, budget=0):
+        """ Returns cached (result, rlimit, time, output goal hash) or None. """
+        key = (goal_hash, strategy, float(timeout), int(budget))
+        value = self.entries.get(key)
+        if value is None:
+            value = self.pending.get(key)
+        if value is None and self.conn is not None:
+            row = self.conn.execute('SELECT res, rlimit, rtime, out_hash FROM solve_results WHERE '
+                                    'goal_hash = ? AND strategy = ? AND timeout = ? AND budget = ? AND z3_version = ?',
+                                    key + (self.z3_version,)).fetchone()
+            if row is not None:
+                value = tuple(row)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.remember(key, value)
+        self.touched.add(key)
+        return value
+
+    def put(self, goal_hash, strategy, timeout, value, budget=0):
+        key = (goal_hash, strategy, float(timeout), int(budget))
+        value = tuple(value)
+        self.remember(key, value)
+        if self.conn is None:
+            return
+        self.pending[key] = value
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.conn is None:
+            return
+        now = time.time()
+        for key, value in self.pending.items():
+            if self.conn.execute('INSERT OR IGNORE INTO solve_results '
+                                 '(goal_hash, strategy, timeout, budget, z3_version, res, rlimit, rtime, out_hash, used) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 key + (self.z3_version,) + value + (now,)).rowcount > 0:
+                self.rows += 1
+            else:
+                self.conn.execute('UPDATE solve_results SET res = ?, rlimit = ?, rtime = ?, out_hash = ?, used = ? '
+                                  'WHERE goal_hash = ? AND strategy = ? AND timeout = ? AND budget = ? AND z3_version = ?',
+                                  value + (now,) + key + (self.z3_version,))
+        self.pending.clear()
+        self.conn.executemany('UPDATE solve_results SET used = ? WHERE '
+                              'goal_hash = ? AND strategy = ? AND timeout = ? AND budget = ? AND z3_version = ?',
+                              [(now,) + key + (self.z3_version,) for key in self.touched])
+        self.touched.clear()
+        if self.rows > self.max_entries:
+            self.rows -= self.conn.execute('DELETE FROM solve_results WHERE rowid IN '
+                                           '(SELECT rowid FROM solve_results ORDER BY used LIMIT ?)',
+                                           (self.rows - self.max_entries,)).rowcount
+        self.conn.commit()
+
+    def stats(self):
+        tot = self.hits + self.misses
+        return 'result cache: {} hits, {} misses, hit rate {:.2f}'.format(self.hits, self.misses,
+                                                                           self.hits / tot if tot > 0 else 0.0)
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+
+class GoalCache:
+    """ Persistent store of transformed goals, keyed by (input goal hash, tactic) of the current z3 version.
+
+    Output goals are stored as zlib compressed SMT2. Once the stored bytes exceed max_bytes the least
+    recently used goals are evicted on flush. Like in ResultCache writes are buffered until flush and the
+    stored bytes are summed on open and then tracked by the own writes and evictions.
+    """
+
+    def __init__(self, path, max_bytes=1 << 30, flush_every=256):
+        """ Opens (and creates if needed) goal database.
+
+        :param path: path of the database file
+        :param max_bytes: maximum number of compressed bytes kept in the database
+        :param flush_every: number of buffered writes which triggers a commit
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.z3_version = z3.get_version_string()
+        self.touched = set()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS goals ('
+                          'goal_hash TEXT, tactic TEXT, z3_version TEXT, goal BLOB, size INTEGER, used REAL, '
+                          'PRIMARY KEY (goal_hash, tactic, z3_version))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS goals_used ON goals (used)')
+        self.conn.commit()
+        self.total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM goals').fetchone()[0]
+
+    def get(self, goal_hash, tactic):
+        """ Returns SMT2 of the goal obtained by applying tactic to the goal with given hash, or None. """
+        data = self.pending.get((goal_hash, tactic))
+        if data is None:
+            row = self.conn.execute('SELECT goal FROM goals WHERE goal_hash = ? AND tactic = ? AND z3_version = ?',
+                                    (goal_hash, tactic, self.z3_version)).fetchone()
+            if row is not None:
+                data = row[0]
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched.add((goal_hash, tactic))
+        return zlib.decompress(data).decode('utf-8')
+
+    def put(self, goal_hash, tactic, smt2):
+        self.pending[(goal_hash, tactic)] = zlib.compress(smt2.encode('utf-8'))
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        now = time.time()
+        for (goal_hash, tactic), data in self.pending.items():
+            row = self.conn.execute('SELECT size FROM goals WHERE goal_hash = ? AND tactic = ? AND z3_version = ?',
+                                    (goal_hash, tactic, self.z3_version)).fetchone()
+            if row is not None:
+                self.total -= row[0]
+            self.conn.execute('INSERT OR REPLACE INTO goals VALUES (?, ?, ?, ?, ?, ?)',
+                              (goal_hash, tactic, self.z3_version, data, len(data), now))
+            self.total += len(data)
+        self.pending.clear()
+        self.conn.executemany('UPDATE goals SET used = ? WHERE goal_hash = ? AND tactic = ? AND z3_version = ?',
+                              [(now, goal_hash, tactic, self.z3_version) for goal_hash, tactic in self.touched])
+        self.touched.clear()
+        if self.total > self.max_bytes:
+            evicted = []
+            for rowid, size in self.conn.execute('SELECT rowid, size FROM goals ORDER BY used'):
+                if self.total <= self.max_bytes:
+                    break
+                evicted.append((rowid,))
+                self.total -= size
+            self.conn.executemany('DELETE FROM goals WHERE rowid = ?', evicted)
+        self.conn.commit()
+
+    def stats(self):
+        tot = self.hits + self.misses
+        return 'goal cache: {} hits, {} misses, hit rate {:.2f}'.format(self.hits, self.misses,
+                                                                         self.hits / tot if tot > 0 else 0.0)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
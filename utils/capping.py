@@ -0,0 +1,63 @@
+"""
+Copyright 2023 WHN
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+class Capping:
+    """ Adaptive capping of candidate evaluations, as in ParamILS.
+
+    Every formula remembers the lowest rlimit any candidate needed to solve it, later candidates get a
+    z3 rlimit budget of slack times that cost and are cut off (counted as unsolved) once they exceed it.
+    The policy is read from the "capping" section of the JSON config, e.g.
+
+        "capping": {"enabled": true, "slack": 2.0, "min_rlimit": 100000}
+    """
+
+    def __init__(self, enabled=False, slack=2.0, min_rlimit=100000):
+        """ Initializes object of type Capping.
+
+        :param enabled: whether budgets are handed out at all
+        :param slack: budget of a formula relative to its best known rlimit
+        :param min_rlimit: lower bound of every budget
+        """
+        self.enabled = enabled
+        self.slack = slack
+        self.min_rlimit = min_rlimit
+        self.best = {}
+        self.capped_cnt = 0
+
+    @staticmethod
+    def from_config(config):
+        return Capping(**config.get('capping', {}))
+
+    def observe(self, key, res, rlimit):
+        """ Records the cost of a finished evaluation of formula key. """
+        if res == 'sat' or res == 'unsat':
+            self.best[key] = min(self.best.get(key, rlimit), rlimit)
+
+    def budget(self, key):
+        """ Returns rlimit budget of formula key, None if it is unlimited. """
+        if not self.enabled or key not in self.best:
+            return None
+        return max(self.min_rlimit, int(self.slack * self.best[key]))
+
+    def capped(self, res, rlimit, budget):
+        """ Returns whether an evaluation with the given budget was (or would have been) cut off. A solved
+        result over budget, e.g. one from the result cache, counts as capped as well, so rankings do not
+        depend on what is cached. """
+        if budget is None or rlimit < budget:
+            return False
+        self.capped_cnt += 1
+        return True
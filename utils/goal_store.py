@@ -0,0 +1,110 @@
+"""
+Copyright 2023 WHN
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import z3
+
+
+def goal_size(formula):
+    """ Returns number of expressions of formula, used as memory estimate of a goal. """
+    g = z3.Goal()
+    g.add(formula)
+    return int(z3.Probe('num-exprs')(g))
+
+
+def to_smt2(formula):
+    s = z3.Solver()
+    s.add(formula)
+    return s.to_smt2()
+
+
+class GoalStore:
+    """ Memory bounded store of intermediate goals.
+
+    Goals are kept in memory until their total size (in expressions) exceeds the budget, then the least
+    recently used goals are written to SMT2 files and parsed back when they are needed again.
+    """
+
+    def __init__(self, budget=5000000, spill_dir=None):
+        """ Initializes object of type GoalStore.
+
+        :param budget: maximum number of expressions kept in memory
+        :param spill_dir: directory for spilled goals, a temporary directory is used if None
+        """
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.own_dir = False
+        self.goals = OrderedDict()
+        self.sizes = {}
+        self.spilled = {}
+        self.mem_size = 0
+        self.next_id = 0
+        self.spill_cnt = 0
+
+    def put(self, formula):
+        handle = self.next_id
+        self.next_id += 1
+        self.goals[handle] = formula
+        self.sizes[handle] = goal_size(formula)
+        self.mem_size += self.sizes[handle]
+        self.shrink(keep=handle)
+        return handle
+
+    def get(self, handle):
+        if handle in self.goals:
+            self.goals.move_to_end(handle)
+            return self.goals[handle]
+        formula = z3.parse_smt2_file(self.spilled[handle])
+        return formula
+
+    def release(self, handle):
+        if handle in self.goals:
+            del self.goals[handle]
+            self.mem_size -= self.sizes[handle]
+        if handle in self.spilled:
+            os.remove(self.spilled.pop(handle))
+        self.sizes.pop(handle, None)
+
+    def shrink(self, keep=None):
+        for handle in list(self.goals.keys()):
+            if self.mem_size <= self.budget:
+                break
+            if handle == keep:
+                continue
+            self.spill(handle)
+
+    def spill(self, handle):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='goals_')
+            self.own_dir = True
+        path = os.path.join(self.spill_dir, 'goal_{}_{}.smt2'.format(os.getpid(), handle))
+        with open(path, 'w') as f:
+            f.write(to_smt2(self.goals.pop(handle)))
+        self.spilled[handle] = path
+        self.mem_size -= self.sizes[handle]
+        self.spill_cnt += 1
+
+    def close(self):
+        for handle in list(self.sizes.keys()):
+            self.release(handle)
+        if self.own_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+            self.own_dir = False
@@ -0,0 +1,128 @@
+"""
+Copyright 2023 WHN
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import multiprocessing
+import queue
+from multiprocessing import util
+
+_exit_funcs = []
+
+
+def at_exit(func):
+    """ Registers func to be called once the tasks of the current pool are done: in a worker process when
+    the pool is closed, in the calling process when it evaluated the tasks itself. Lets initializers open
+    resources whose buffered writes must not be lost when the pool is done. """
+    _exit_funcs.append(func)
+
+
+def _run_exit_funcs():
+    while len(_exit_funcs) > 0:
+        _exit_funcs.pop()()
+
+
+def _init_worker(initializer, initargs):
+    util.Finalize(None, _run_exit_funcs, exitpriority=10)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def get_context():
+    """ Returns multiprocessing context used by all worker pools.
+    Workers are spawned instead of forked so that every worker owns a fresh z3 context. """
+    return multiprocessing.get_context('spawn')
+
+
+def _call_task(args):
+    func, task = args
+    return task, func(task)
+
+
+def imap_tasks(func, tasks, workers=1, initializer=None, initargs=()):
+    """ Applies func to every task and yields (task, result) pairs.
+
+    With workers <= 1 tasks are evaluated in the calling process in the given order,
+    otherwise they are fanned out to a process pool and yielded in completion order.
+
+    :param func: module level function taking a single task
+    :param tasks: list of picklable tasks
+    :param workers: number of worker processes
+    :param initializer: function called once in every worker process
+    :param initargs: arguments for initializer
+    """
+    if workers <= 1:
+        try:
+            if initializer is not None:
+                initializer(*initargs)
+            for task in tasks:
+                yield task, func(task)
+        finally:
+            _run_exit_funcs()
+        return
+
+    with get_context().Pool(workers, _init_worker, (initializer, initargs)) as pool:
+        for task, res in pool.imap_unordered(_call_task, [(func, task) for task in tasks]):
+            yield task, res
+        # let the workers exit on their own so that they run their exit functions
+        pool.close()
+        pool.join()
+
+
+def expand_tasks(func, tasks, expand, workers=1, initializer=None, initargs=()):
+    """ Applies func to every task and yields (task, result) pairs, like imap_tasks, but every result can
+    spawn further tasks which are scheduled on the same pool.
+
+    :param func: module level function taking a single task
+    :param tasks: list of picklable initial tasks
+    :param expand: function called in the calling process with (task, result), returns list of new tasks
+    :param workers: number of worker processes
+    :param initializer: function called once in every worker process
+    :param initargs: arguments for initializer
+    """
+    if workers <= 1:
+        try:
+            if initializer is not None:
+                initializer(*initargs)
+            pending = list(tasks)
+            while len(pending) > 0:
+                task = pending.pop(0)
+                res = func(task)
+                pending += expand(task, res)
+                yield task, res
+        finally:
+            _run_exit_funcs()
+        return
+
+    done = queue.Queue()
+    with get_context().Pool(workers, _init_worker, (initializer, initargs)) as pool:
+        def submit(task):
+            pool.apply_async(_call_task, ((func, task),), callback=done.put, error_callback=done.put)
+
+        running = 0
+        for task in tasks:
+            submit(task)
+            running += 1
+        while running > 0:
+            res = done.get()
+            running -= 1
+            if isinstance(res, BaseException):
+                raise res
+            task, res = res
+            for n_task in expand(task, res):
+                submit(n_task)
+                running += 1
+            yield task, res
+        pool.close()
+        pool.join()
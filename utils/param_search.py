@@ -0,0 +1,193 @@
+"""
+Copyright 2023 WHN
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import sqlite3
+
+import numpy as np
+import z3
+
+from language.objects import Tactic
+from utils.cache import strategy_key
+
+
+class ParamSpace:
+    """ Parameters of all With tactics of a tactic sequence, as described by StrategyEnumerator.
+
+    A point of the space is a vector in [0, 1]^d which StrategyEnumerator.get_tactic_with_args scales to
+    the parameter ranges, so different points can map to the same tactic sequence.
+    """
+
+    def __init__(self, enumerator, tactics):
+        """ Initializes object of type ParamSpace.
+
+        :param enumerator: StrategyEnumerator holding parameter ranges
+        :param tactics: list of tactic names
+        """
+        self.enumerator = enumerator
+        self.tactics = list(tactics)
+        self.dims = []
+        for pos, tactic in enumerate(self.tactics):
+            booleans = enumerator.allowed_params.get(tactic, {}).get('boolean', [])
+            for param in enumerator.param_max.get(tactic, {}):
+                self.dims.append((pos, tactic, param, param in booleans))
+        self.is_bool = np.array([dim[3] for dim in self.dims], dtype=bool)
+
+    def __len__(self):
+        return len(self.dims)
+
+    def key(self):
+        return ','.join(self.tactics)
+
+    def tactic_seq(self, x):
+        """ Returns list of Tactic and With objects of point x. """
+        args = [{} for _ in self.tactics]
+        for (pos, _, param, _), value in zip(self.dims, x):
+            args[pos][param] = float(value)
+        return [self.enumerator.get_tactic_with_args(tactic, args[pos]) if len(args[pos]) > 0 else Tactic(tactic)
+                for pos, tactic in enumerate(self.tactics)]
+
+
+class TPE:
+    """ Tree-structured Parzen estimator over [0, 1]^d with boolean and numeric dimensions.
+
+    Observations are split into the gamma best and the rest, each dimension of both groups is modelled
+    by a Parzen estimator (smoothed frequencies for booleans, gaussian mixture with a uniform prior for
+    numeric dimensions), and new points are the candidates with the highest ratio l(x) / g(x).
+    """
+
+    def __init__(self, is_bool, gamma=0.25, n_startup=8, n_candidates=64, seed=None):
+        """ Initializes object of type TPE.
+
+        :param is_bool: boolean mask of the dimensions
+        :param gamma: fraction of observations which form the good group
+        :param n_startup: number of uniform random points before the model is used
+        :param n_candidates: number of points sampled from l(x) per proposed point
+        :param seed: seed of the random generator
+        """
+        self.is_bool = np.asarray(is_bool, dtype=bool)
+        self.gamma = gamma
+        self.n_startup = n_startup
+        self.n_candidates = n_candidates
+        self.rng = np.random.RandomState(seed)
+        self.xs = []
+        self.ys = []
+
+    def tell(self, x, y):
+        self.xs.append(np.asarray(x, dtype=np.float64))
+        self.ys.append(float(y))
+
+    def ask(self, n):
+        """ Returns (n * n_candidates, d) matrix of candidate points, best first. """
+        d = len(self.is_bool)
+        m = n * self.n_candidates
+        if len(self.xs) < self.n_startup:
+            return self.rng.rand(m, d)
+
+        xs = np.stack(self.xs)
+        order = np.argsort(self.ys, kind='stable')
+        n_good = max(1, int(np.ceil(self.gamma * len(order))))
+        good, bad = xs[order[:n_good]], xs[order[n_good:]]
+
+        cand = self.sample(good, m)
+        score = self.log_pdf(good, cand) - self.log_pdf(bad, cand)
+        return cand[np.argsort(-score, kind='stable')]
+
+    def bandwidth(self, points):
+        n = len(points)
+        if n < 2:
+            return np.full(points.shape[1], 0.5)
+        return np.clip(points.std(axis=0) * n ** -0.2, 0.05, 0.5)
+
+    def sample(self, points, m):
+        d = points.shape[1]
+        n = len(points)
+        res = np.empty((m, d))
+
+        # booleans: smoothed frequency of ones in points
+        p = (points[:, self.is_bool].sum(axis=0) + 1) / (n + 2)
+        res[:, self.is_bool] = (self.rng.rand(m, int(self.is_bool.sum())) < p) * 1.0
+
+        # numeric: pick a kernel (or the uniform prior with weight 1 / (n + 1)) and perturb it
+        num = ~self.is_bool
+        if num.any():
+            sigma = self.bandwidth(points[:, num])
+            comp = self.rng.randint(0, n + 1, size=m)
+            prior = comp == n
+            comp = np.minimum(comp, n - 1)
+            vals = points[comp][:, num] + self.rng.randn(m, int(num.sum())) * sigma
+            vals[prior] = self.rng.rand(int(prior.sum()), int(num.sum()))
+            res[:, num] = np.clip(vals, 0, 1)
+        return res
+
+    def log_pdf(self, points, cand):
+        n = len(points)
+        res = np.zeros(len(cand))
+        if n == 0:
+            return res
+
+        p = (points[:, self.is_bool].sum(axis=0) + 1) / (n + 2)
+        bits = cand[:, self.is_bool] >= 0.5
+        res += np.log(np.where(bits, p, 1 - p)).sum(axis=1)
+
+        num = ~self.is_bool
+        if num.any():
+            sigma = self.bandwidth(points[:, num])
+            diff = (cand[:, num][:, None, :] - points[:, num][None, :, :]) / sigma
+            kernel = np.exp(-0.5 * diff ** 2) / (sigma * np.sqrt(2 * np.pi))
+            dens = (kernel.sum(axis=1) + 1) / (n + 1)
+            res += np.log(dens).sum(axis=1)
+        return res
+
+
+class TrialHistory:
+    """ Parameter points evaluated by earlier tuner runs, keyed by (tactic names, z3 version).
+
+    Costs depend on the benchmark sample, so only the points are stored, the tuner evaluates them again
+    through the result cache. The table can live in the same database file as the ResultCache.
+    """
+
+    def __init__(self, path):
+        """ Opens (and creates if needed) trial table.
+
+        :param path: path of the database file
+        """
+        self.path = path
+        self.z3_version = z3.get_version_string()
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS param_trials ('
+                          'tactics TEXT, z3_version TEXT, strategy TEXT, params TEXT, '
+                          'PRIMARY KEY (tactics, z3_version, strategy))')
+        self.conn.commit()
+
+    def get(self, tactics):
+        """ Returns list of stored points of tactic sequence tactics. """
+        rows = self.conn.execute('SELECT params FROM param_trials WHERE tactics = ? AND z3_version = ?',
+                                 (tactics, self.z3_version)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def put(self, tactics, tac_seq, x):
+        self.conn.execute('INSERT OR REPLACE INTO param_trials VALUES (?, ?, ?, ?)',
+                          (tactics, self.z3_version, strategy_key(tac_seq), json.dumps([float(v) for v in x])))
+
+    def flush(self):
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
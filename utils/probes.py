@@ -0,0 +1,89 @@
+"""
+Copyright 2023 WHN
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import z3
+
+from utils.cache import goal_hash
+
+
+class ProbeFeatures:
+    """ Evaluates all z3 probes of a goal in a single pass.
+
+    Probe objects are constructed once, feature vectors are memoized by goal hash (LRU bounded by
+    max_entries), so goals which show up again in the tuner, the agent or the combiner are not probed twice.
+    """
+
+    def __init__(self, names=None, max_entries=100000):
+        """ Initializes object of type ProbeFeatures.
+
+        :param names: names of probes to evaluate, all z3 probes if None
+        :param max_entries: maximum number of memoized feature vectors
+        """
+        self.names = list(names) if names is not None else z3.probes()
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.probes = [z3.Probe(name) for name in self.names]
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def features(self, formula, key=None):
+        """ Returns vector of all probe values of formula (expression, AST vector or goal).
+
+        :param key: precomputed goal hash of formula
+        """
+        if key is None:
+            key = goal_hash(formula)
+        value = self.entries.get(key)
+        if value is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+        self.misses += 1
+        if isinstance(formula, z3.Goal):
+            g = formula
+        else:
+            g = z3.Goal()
+            g.add(formula)
+        value = np.array([p(g) for p in self.probes], dtype=np.float64)
+        self.entries[key] = value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+    def matrix(self, formulas):
+        """ Returns (len(formulas), len(self.names)) matrix of probe values. """
+        if len(formulas) == 0:
+            return np.zeros((0, len(self.names)), dtype=np.float64)
+        return np.stack([self.features(formula) for formula in formulas])
+
+    def column(self, matrix, name):
+        return matrix[:, self.index[name]]
+
+
+_default = None
+
+
+def default_features():
+    """ Returns ProbeFeatures shared inside current process. """
+    global _default
+    if _default is None:
+        _default = ProbeFeatures()
+    return _default
@@ -0,0 +1,169 @@
+"""
+Copyright 2023 WHN
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import queue
+import signal
+import threading
+
+import z3
+
+from utils import parallel
+
+
+def _serve(conn):
+    conn.send(('ready', None))
+    while True:
+        # unpickling the task may import the module of func, the deadline starts once that is done
+        task = conn.recv()
+        if task is None:
+            break
+        conn.send(('started', None))
+        func, args, timeout = task
+        done = threading.Event()
+        expired = threading.Event()
+
+        def watchdog():
+            if done.wait(timeout):
+                return
+            expired.set()
+            # keep interrupting, the task may start further z3 calls after the first one was cancelled
+            while True:
+                z3.main_ctx().interrupt()
+                if done.wait(0.05):
+                    return
+
+        watcher = None
+        if timeout is not None and timeout > 0:
+            watcher = threading.Thread(target=watchdog, daemon=True)
+            watcher.start()
+        try:
+            status, value = 'ok', func(*args)
+        except Exception as e:
+            status, value = 'error', e
+        done.set()
+        if watcher is not None:
+            watcher.join()
+        if expired.is_set():
+            status, value = 'timeout', None
+        conn.send((status, value))
+    conn.close()
+
+
+class SolverWorker:
+    """ Long-lived worker process which runs solver calls one at a time.
+
+    A call which misses its deadline is cancelled cooperatively by interrupting the z3 context of the
+    worker, if it does not return within the grace period the worker is killed and replaced. A call which
+    raised replaces the worker as well, since z3 keeps the error in the context. Deadlines only start once
+    the worker picked up the call, so the start up of a (replaced) worker is never counted.
+    """
+
+    def __init__(self):
+        self.respawn_cnt = 0
+        self.start()
+
+    def start(self):
+        ctx = parallel.get_context()
+        conn, child_conn = ctx.Pipe()
+        self.conn = conn
+        self.p = ctx.Process(target=_serve, args=(child_conn,), daemon=True)
+        self.p.start()
+        child_conn.close()
+        self.ready = False
+
+    def restart(self):
+        if self.p.is_alive():
+            os.kill(self.p.pid, signal.SIGKILL)
+        self.p.join()
+        self.conn.close()
+        self.respawn_cnt += 1
+        self.start()
+
+    def call(self, func, args, timeout=None, grace=1):
+        """ Returns func(*args) evaluated in the worker.
+
+        :param func: module level function
+        :param args: tuple of picklable arguments
+        :param timeout: deadline of the call in seconds, None or 0 for none
+        :param grace: seconds between the interrupt and the kill of the worker
+        :raise TimeoutError: if the call missed the deadline
+        """
+        try:
+            if not self.ready:
+                self.conn.recv()
+                self.ready = True
+            self.conn.send((func, args, timeout))
+            self.conn.recv()
+            if timeout is None or timeout <= 0 or self.conn.poll(timeout + grace):
+                status, value = self.conn.recv()
+            else:
+                self.restart()
+                raise TimeoutError('solver call killed after {} seconds'.format(timeout + grace))
+        except (EOFError, BrokenPipeError):
+            self.restart()
+            raise RuntimeError('solver worker exited unexpectedly')
+        if status == 'timeout':
+            raise TimeoutError('solver call interrupted after {} seconds'.format(timeout))
+        if status == 'error':
+            self.restart()
+            raise value
+        return value
+
+    def close(self):
+        if self.p.is_alive():
+            self.conn.send(None)
+        self.p.join()
+        self.conn.close()
+
+
+class SolverPool:
+    """ Fixed number of SolverWorkers shared by the threads of a process, started on first use. """
+
+    def __init__(self, size=1, grace=1):
+        """ Initializes object of type SolverPool.
+
+        :param size: number of worker processes
+        :param grace: seconds a cancelled call may take before its worker is killed
+        """
+        self.size = size
+        self.grace = grace
+        self.idle = None
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def call(self, func, args, timeout=None):
+        """ Returns func(*args) evaluated in an idle worker, see SolverWorker.call. """
+        with self.lock:
+            if self.idle is None:
+                self.idle = queue.Queue()
+                self.workers = [SolverWorker() for _ in range(max(self.size, 1))]
+                for worker in self.workers:
+                    self.idle.put(worker)
+        worker = self.idle.get()
+        try:
+            return worker.call(func, args, timeout, self.grace)
+        finally:
+            self.idle.put(worker)
+
+    def respawn_cnt(self):
+        return sum(worker.respawn_cnt for worker in self.workers)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+        self.idle = None